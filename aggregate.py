@@ -0,0 +1,134 @@
+#====== EDGE AGGREGATION ================#
+# Per sensor processing between reading a sample and publishing it. Sample fast locally and publish
+# only what matters:
+#   'raw'      = publish every sample (original behavior)
+#   'deadband' = report by exception. Publish a sample only when a field moved more than its deadband
+#                since the last published sample (or max_silence sec passed, as a heartbeat)
+#   'summary'  = publish min/max/mean/std of each field once per window (tumbling window)
+# 'summary' keeps the samples in a fixed-size ring buffer per sensor. With NumPy installed the window is
+# one 2D array (fields x samples) and the aggregates are computed for all fields in one vectorized call.
+# NumPy is imported with the first summary window, so 'raw' and 'deadband' never pay for the import.
+#     processor = SensorProcessor(('sensorData1f', 'sensorData2i'), mode='deadband', deadband=0.5)
+#     out = processor.add(outgoingD['data'])   # None = nothing to publish
+#     if out: kind, data = out                 # kind 'sample' or 'summary'
+
+import math
+from array import array
+from time import perf_counter
+
+np = None                # Set by _numpy() on the first summary window
+_np_loaded = False
+
+def _numpy():
+    """ The numpy module or None (pure python fallback with the array module). Imported once, lazily """
+    global np, _np_loaded
+    if not _np_loaded:
+        _np_loaded = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+    return np
+
+RAW, DEADBAND, SUMMARY = 'raw', 'deadband', 'summary'
+MODES = (RAW, DEADBAND, SUMMARY)
+
+class SampleWindow:
+    """ Ring buffer of the last 'size' samples for a fixed set of fields """
+
+    def __init__(self, fields, size=60):
+        if size < 1:
+            raise ValueError("window size must be >= 1 (got {0})".format(size))
+        self.fields = tuple(fields)
+        self.size = size
+        self.count = 0          # Valid samples (max size)
+        self._i = 0             # Next write position
+        self._np = _numpy()
+        if self._np is not None:
+            self._buf = np.zeros((len(self.fields), size))
+        else:
+            self._buf = [array('d', [0.0]) * size for _ in self.fields]
+
+    def append(self, sample):
+        i = self._i
+        if self._np is not None:
+            self._buf[:, i] = [sample[field] for field in self.fields]
+        else:
+            for row, field in zip(self._buf, self.fields):
+                row[i] = sample[field]
+        self._i = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        self.count = self._i = 0
+
+    def stats(self):
+        """ {field: {'min', 'max', 'mean', 'std'}} over the samples in the window (population std) """
+        n = self.count
+        if not n:
+            return {}
+        if self._np is not None:
+            data = self._buf[:, :n]     # Unfilled windows start at 0 so the first n columns are the samples
+            mins, maxs, means, stds = data.min(axis=1), data.max(axis=1), data.mean(axis=1), data.std(axis=1)
+            return {field: {'min': float(mins[k]), 'max': float(maxs[k]), 'mean': float(means[k]), 'std': float(stds[k])}
+                    for k, field in enumerate(self.fields)}
+        result = {}
+        for row, field in zip(self._buf, self.fields):
+            values = row[:n]
+            mean = math.fsum(values) / n
+            result[field] = {'min': min(values), 'max': max(values), 'mean': mean,
+                             'std': math.sqrt(math.fsum((v - mean) ** 2 for v in values) / n)}
+        return result
+
+class SensorProcessor:
+    """ Window + deadband/summary decision for one sensor.
+        deadband is one threshold for every field or a {field: threshold} dict """
+
+    def __init__(self, fields, mode=RAW, window=60, deadband=0.0, max_silence=None):
+        if mode not in MODES:
+            raise ValueError("mode must be one of {0} (got {1})".format(MODES, mode))
+        self.mode = mode
+        self.fields = tuple(fields)
+        self.window = SampleWindow(self.fields, window) if mode == SUMMARY else None   # Only summary reads it
+        self.deadband = deadband if isinstance(deadband, dict) else {field: deadband for field in self.fields}
+        self.max_silence = max_silence     # Deadband: publish at least every max_silence sec even if unchanged
+        self._last = None                  # Last published sample (deadband)
+        self._last_t = 0.0
+        self.samples = 0
+        self.published = 0
+
+    def add(self, sample, now=None):
+        """ Add a sample. Returns ('sample', sample), ('summary', stats) or None when there is nothing to publish """
+        self.samples += 1
+        if self.mode == RAW:
+            self.published += 1
+            return 'sample', sample
+        now = perf_counter() if now is None else now
+        if self.mode == DEADBAND:
+            if self._changed(sample) or (self.max_silence is not None and now - self._last_t >= self.max_silence):
+                self._last = {field: sample[field] for field in self.fields}
+                self._last_t = now
+                self.published += 1
+                return 'sample', sample
+            return None
+        self.window.append(sample)                     # SUMMARY
+        if self.window.count >= self.window.size:      # Tumbling window is full
+            summary = self.window.stats()
+            summary['n'] = self.window.count
+            self.window.clear()
+            self.published += 1
+            return 'summary', summary
+        return None
+
+    def _changed(self, sample):
+        if self._last is None:
+            return True
+        for field, last in self._last.items():
+            if abs(sample[field] - last) > self.deadband.get(field, 0.0):
+                return True
+        return False
+
+    def stats(self):
+        return {'mode': self.mode, 'samples': self.samples, 'published': self.published}
@@ -0,0 +1,217 @@
+#====== ASYNCIO RUNTIME =================#
+# Alternative to loop_start()/ReconnectSupervisor threads. The paho socket is driven from the
+# asyncio event loop: loop_read when the socket is readable, loop_write when paho has data queued,
+# loop_misc once a second for keepalives. Every paho callback then runs on the event loop thread so
+# handlers, sensors and the mqtt client share state without locks and nothing polls.
+# paho's connect()/reconnect() are blocking (up to its 5 sec connect timeout). Each attempt first
+# opens a probe TCP connection with asyncio, so paho only connects to a broker that is answering and
+# an outage never freezes the loop.
+#     aclient = AsyncClient(mqtt_client, spool=spool)
+#     await aclient.connect('rpi3mqtt1.local', 1883)
+#     await aclient.subscribe('template/host/instructions')
+#     await aclient.publish('demo/sensor/data', payload, qos=1)    # returns when acked (qos 0: when written)
+#     asyncio.create_task(every(3.0, read_sensor, 1))               # one task per sensor, fixed rate
+
+import asyncio, logging, random, socket
+import paho.mqtt.client as mqtt
+from scheduler import Job
+
+class AsyncClient:
+    """ Wraps a configured paho mqtt.Client. The client's own on_connect/on_disconnect/on_publish/on_subscribe
+        callbacks still run (after the futures are resolved) so existing callbacks can be reused """
+
+    def __init__(self, client, spool=None, min_delay=1.0, max_delay=120.0, drain_rate=50.0, metrics=None, loop=None,
+                 connect_timeout=5.0):
+        self.client = client
+        self.spool = spool                # Optional spool.Spool used while disconnected
+        self.metrics = metrics            # Optional metrics.Metrics. Every publish mid is reported to it
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.drain_rate = drain_rate
+        self.connect_timeout = connect_timeout   # Probe connect timeout (sec)
+        self.loop = loop
+        self.connections = 0
+        self._addr = None                 # (ip, port) of the last connect(), probed before each reconnect
+        self._connected = None            # Future for the pending CONNACK
+        self._pending = {}                # mid -> Future (publish and subscribe)
+        self._early = set()               # mids acked before publish() returned
+        self._misc_task = None
+        self._reconnect_task = None
+        self._drain_task = None
+        self._closing = False
+        self._user = {name: getattr(client, name) for name in ('on_connect', 'on_disconnect', 'on_publish', 'on_subscribe')}
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        client.on_subscribe = self._on_subscribe
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    #==== SOCKET <-> EVENT LOOP ========#
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self.loop.create_task(self._misc())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc(self):
+        """ Keepalive pings and timeouts. Ends when the socket is gone """
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1.0)
+
+    #==== CALLBACK HOOKS ===============#
+    def _on_connect(self, client, userdata, flags, rc):
+        if self._connected is not None and not self._connected.done():
+            if rc == 0:
+                self._connected.set_result(flags)
+            else:
+                self._connected.set_exception(ConnectionError("(mqtt) connection refused, code {0}".format(rc)))
+        if rc == 0:
+            self.connections += 1
+            if self.spool is not None and len(self.spool) and (self._drain_task is None or self._drain_task.done()):
+                self._drain_task = self.loop.create_task(self._drain())
+        if self._user['on_connect'] is not None:
+            self._user['on_connect'](client, userdata, flags, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("(mqtt) disconnected, code {0}".format(rc)))
+        self._pending.clear()
+        self._early.clear()
+        if self._user['on_disconnect'] is not None:
+            self._user['on_disconnect'](client, userdata, rc)
+        if not self._closing and (self._reconnect_task is None or self._reconnect_task.done()):
+            self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    def _on_publish(self, client, userdata, mid):
+        future = self._pending.pop(mid, None)
+        if future is None:
+            self._early.add(mid)
+        elif not future.done():
+            future.set_result(mid)
+        if self._user['on_publish'] is not None:
+            self._user['on_publish'](client, userdata, mid)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        future = self._pending.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(granted_qos)
+        if self._user['on_subscribe'] is not None:
+            self._user['on_subscribe'](client, userdata, mid, granted_qos)
+
+    async def _probe(self, addr, port):
+        """ TCP connect and close without blocking the loop. Raises OSError (socket.timeout) if the broker
+            doesn't answer within connect_timeout, the same errors paho's blocking connect raises """
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(addr, port), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("connect to {0}:{1} timed out".format(addr, port)) from None
+        writer.close()
+
+    #==== AWAITABLE API ================#
+    async def connect(self, host, port=1883, keepalive=60):
+        """ Resolve and probe (without blocking the loop), connect and wait for CONNACK """
+        self.loop = self.loop or asyncio.get_running_loop()
+        self._closing = False
+        addr = (await self.loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))[0][4][0]
+        self._addr = (addr, port)
+        await self._probe(addr, port)
+        self._connected = self.loop.create_future()
+        self.client.connect(addr, port, keepalive)     # Broker answered so this returns quickly. CONNACK arrives via loop_read
+        return await self._connected
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        """ Returns the mid once acked (qos 1/2) or written (qos 0). Spooled (returns None) while disconnected """
+        if self.spool is not None and (not self.client.is_connected() or len(self.spool)):
+            self.spool.append(topic, payload, qos)
+            return None
+        info = self.client.publish(topic, payload, qos, retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            if self.spool is not None:
+                self.spool.append(topic, payload, qos)
+                return None
+            raise ConnectionError("(mqtt) publish failed: {0}".format(mqtt.error_string(info.rc)))
+        if self.metrics is not None:
+            self.metrics.publish_sent(info.mid)
+        if info.mid in self._early:              # qos 0 may be written (and 'acked') inside publish()
+            self._early.discard(info.mid)
+            return info.mid
+        future = self._pending[info.mid] = self.loop.create_future()
+        return await future
+
+    async def subscribe(self, topic, qos=0):
+        """ topic can be a string or a list of (topic, qos). Returns the granted qos tuple """
+        rc, mid = self.client.subscribe(topic, qos)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError("(mqtt) subscribe failed: {0}".format(mqtt.error_string(rc)))
+        future = self._pending[mid] = self.loop.create_future()
+        return await future
+
+    async def disconnect(self):
+        self._closing = True
+        for task in (self._reconnect_task, self._drain_task):
+            if task is not None:
+                task.cancel()
+        self.client.disconnect()
+
+    #==== RECONNECT / SPOOL DRAIN ======#
+    async def _reconnect(self):
+        delay = self.min_delay
+        while not self._closing:
+            await asyncio.sleep(delay * random.uniform(0.75, 1.25))
+            try:
+                if self._addr is not None:
+                    await self._probe(*self._addr)
+                self.client.reconnect()
+                return
+            except (socket.error, OSError) as error:
+                logging.info("(mqtt) reconnect failed: {0}".format(error))
+                delay = min(delay * 2, self.max_delay)
+
+    async def _drain(self):
+        while len(self.spool) and self.client.is_connected():
+            topic, payload, qos = self.spool.peek()
+            info = self.client.publish(topic, payload, qos)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                return
+            if self.metrics is not None:
+                self.metrics.publish_sent(info.mid)
+            self.spool.pop()
+            await asyncio.sleep(1.0 / self.drain_rate)
+
+async def every(interval, func, *args, name=None, job=None):
+    """ Call func(*args) (plain function or coroutine function) at a fixed rate without drift.
+        Jitter stats are kept in a scheduler.Job (pass one in to read job.stats() elsewhere) """
+    loop = asyncio.get_running_loop()
+    job = job or Job(name or getattr(func, '__name__', 'task'), interval, func, args)
+    deadline = loop.time() + interval
+    while not job.cancelled:
+        await asyncio.sleep(max(deadline - loop.time(), 0))
+        now = loop.time()
+        job.record(now - deadline)
+        try:
+            result = func(*args)
+            if asyncio.iscoroutine(result):
+                await result
+        except (ConnectionError, RuntimeError) as error:
+            logging.info("(aio) {0}: {1}".format(job.name, error))
+        except Exception:                 # Log and keep the task running, like Scheduler.run_pending
+            logging.exception("(aio) job {0} raised".format(job.name))
+        deadline += interval
+        now = loop.time()
+        if deadline <= now:               # Overran. Skip missed deadlines (fixed rate, no burst to catch up)
+            skipped = int((now - deadline) // interval) + 1
+            job.missed += skipped
+            deadline += skipped * interval
@@ -0,0 +1,266 @@
+#====== BENCHMARK =======================#
+# Measures the template.py publish path (sample_and_publish -> supervisor -> paho) and the
+# on_message path (on_message -> inbound queue -> router -> handle_instructions) against the local
+# stand-in broker (localbroker.py), so no network or real broker is needed.
+# The broker runs in a child process so CPU% and RSS are for the device code (plus the bench
+# subscriber/publisher client used to timestamp messages).
+# Results are JSON, one object per run, for comparing before/after a performance change.
+#     python3 benchmark.py --mode publish --sensors 4 --rate 500 --duration 10
+#     python3 benchmark.py --mode inbound --rate 0 --payload-size 256 --output bench_output.txt
+# --rate is messages/sec per sensor (publish) or in total (inbound). 0 = as fast as possible.
+
+import argparse, json, logging, math, multiprocessing, os, resource, threading, types
+from time import perf_counter, process_time, sleep
+import paho.mqtt.client as mqtt
+
+import template
+import tracing
+from inbound import InboundQueue
+from aggregate import SensorProcessor
+from history import SensorHistory
+from localbroker import LocalBroker
+from metrics import Metrics
+from pipeline import PublishPipeline
+from router import TopicRouter
+from scheduler import Scheduler
+from supervisor import ReconnectSupervisor
+
+#====== HELPERS =========================#
+def _broker_process(conn):
+    broker = LocalBroker(port=0).start()
+    conn.send(broker.port)
+    conn.recv()                    # Parent says stop
+    conn.send(broker.stats())
+    broker.stop()
+
+def start_broker():
+    """ Local broker in a child process. Returns (port, stop function returning the broker stats) """
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_broker_process, args=(child,), daemon=True)
+    proc.start()
+    port = parent.recv()
+    def stop():
+        parent.send('stop')
+        stats = parent.recv() if parent.poll(5.0) else {}
+        proc.join(5.0)
+        return stats
+    return port, stop
+
+def rss_mb():
+    """ Current resident set size (Linux /proc), falls back to the peak from getrusage """
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6, 1)
+    except (OSError, ValueError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3, 1)
+
+def connect_client(client_id, port, timeout=5.0):
+    connected = threading.Event()
+    client = mqtt.Client(client_id)
+    client.on_connect = lambda c, u, f, rc: connected.set()
+    client.connect('127.0.0.1', port)
+    client.loop_start()
+    if not connected.wait(timeout):
+        raise RuntimeError("bench client {0} could not connect to the local broker".format(client_id))
+    return client
+
+def wire_template(port, qos, max_inflight=20, backpressure='block'):
+    """ Set up the template.py globals the same way template.main() does, pointed at the local broker """
+    template.metrics = Metrics()
+    template.MQTT_SUB_TOPIC = 'template/host/instructions'
+    template.MQTT_PUB_RPI_TOPIC = 'template/host/info'
+    template.MQTT_PUB_METRICS_TOPIC = template.MQTT_PUB_RPI_TOPIC + '/metrics'
+    template.MQTT_PUB_HISTORY_TOPIC = template.MQTT_PUB_RPI_TOPIC + '/history'
+    template.HISTORY_MAX_ROWS = 1000
+    template.demoHostMachine = {}
+    template.router = TopicRouter()
+    template.router.add(template.MQTT_SUB_TOPIC, template.handle_instructions, qos)
+    template.inbound = InboundQueue(template.router.dispatch, maxsize=4096, workers=2).start()
+    mqtt.Client.connected = False
+    mqtt.Client.failed_connection = False
+    mqtt.Client.startup_sec = None
+    client = template.mqtt_client = mqtt.Client('bench-device')
+    client.on_connect = template.on_connect
+    client.on_disconnect = template.on_disconnect
+    client.on_message = template.on_message
+    client.on_publish = template.on_publish
+    client.connect_async('127.0.0.1', port)
+    template.supervisor = ReconnectSupervisor(client, metrics=template.metrics, loop_timeout=0.1)
+    template.pipeline = PublishPipeline(template.supervisor, max_inflight=max_inflight, mode=backpressure, block_timeout=1.0)
+    template.batcher = None
+    template.supervisor.start()
+    template.outgoingD = {'data': {}}
+    deadline = perf_counter() + 5.0
+    while not client.connected and perf_counter() < deadline:
+        sleep(0.01)
+    if not client.connected:
+        raise RuntimeError("template client could not connect to the local broker")
+
+def unwire_template():
+    template.inbound.stop(timeout=1.0)
+    template.supervisor.stop(timeout=2.0)
+    template.mqtt_client.disconnect()
+
+class _Usage:
+    """ Wall time, CPU time and RSS over a measured section """
+
+    def __enter__(self):
+        self.rss_start = rss_mb()
+        self.wall0, self.cpu0 = perf_counter(), process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = perf_counter() - self.wall0
+        self.cpu_pct = round((process_time() - self.cpu0) / self.wall * 100, 1)
+        self.rss = rss_mb()
+
+def _drive(jobs, rate, duration):
+    """ Call every job at rate/sec each (Scheduler) or back to back when rate is 0 """
+    if rate:
+        scheduler = Scheduler()
+        for n, (func, args) in enumerate(jobs):
+            scheduler.every(1.0 / rate, func, *args, name="job{0}".format(n))
+        threading.Timer(duration, scheduler.stop).start()
+        scheduler.run()
+        return scheduler.stats()
+    end = perf_counter() + duration
+    while perf_counter() < end:
+        for func, args in jobs:
+            func(*args)
+    return {}
+
+def _percentile(values, q):
+    """ Exact (nearest rank) percentile of sorted values """
+    return values[min(len(values) - 1, max(math.ceil(q * len(values)) - 1, 0))] if values else 0.0
+
+def _result(mode, args, sent, received, latency, usage, extra):
+    """ latency = every recorded latency in ms (raw, so the percentiles are exact) """
+    latency = sorted(latency)
+    return dict({'mode': mode, 'sensors': args.sensors, 'rate': args.rate, 'payload_size': args.payload_size,
+                 'qos': args.qos, 'codec': args.codec, 'duration': round(usage.wall, 3),
+                 'sent': sent, 'received': received,
+                 'msgs_per_sec': round(received / usage.wall, 1),
+                 'latency_ms': {'p50': round(_percentile(latency, 0.5), 3), 'p99': round(_percentile(latency, 0.99), 3),
+                                'mean': round(math.fsum(latency) / len(latency), 3) if latency else 0.0,
+                                'max': round(latency[-1], 3) if latency else 0.0},
+                 'cpu_pct': usage.cpu_pct, 'rss_mb': usage.rss, 'rss_start_mb': usage.rss_start}, **extra)
+
+#====== SCENARIOS =======================#
+def bench_publish(port, args):
+    """ sample_and_publish for N sensors -> broker -> bench subscriber. Latency is publish call to receipt.
+        Messages from one client arrive in order, so the n-th receipt matches the n-th publish """
+    wire_template(port, args.qos, args.max_inflight, args.backpressure)
+    sent_t, latency = [], []
+    done = threading.Event()
+
+    def on_bench_message(client, userdata, msg):
+        now = perf_counter()
+        n = len(latency)
+        if n < len(sent_t):
+            latency.append((now - sent_t[n]) * 1000)
+        if len(latency) >= len(sent_t) and stop_sending.is_set():
+            done.set()
+
+    subscriber = connect_client('bench-sub', port)
+    subscriber.on_message = on_bench_message
+    subscriber.subscribe('demo/sensor/data', args.qos)
+    sleep(0.2)                                        # Let the SUBACK land before publishing
+
+    supervisor = template.supervisor
+    def timed_publish(topic, payload, qos=0, retain=False):
+        sent_t.append(perf_counter())
+        return supervisor.publish(topic, payload, args.qos, retain)
+    template.pipeline.publisher = types.SimpleNamespace(publish=timed_publish)   # Timestamp what leaves the pipeline
+
+    # Stand-ins for DemoSensor (no GPIO needed). 'pad' makes JSON payloads roughly payload_size bytes
+    sensors = [types.SimpleNamespace(topic='demo/sensor/data', codec=template.codec.get_codec(args.codec),
+                                     processor=SensorProcessor(('sensorData1f', 'sensorData2i')),
+                                     history=SensorHistory((('sensorData1f', 'f'), ('sensorData2i', 'i'))),
+                                     reader=template.read_demo_sensor)
+               for _ in range(args.sensors)]
+    if args.payload_size > 60:
+        template.outgoingD['data']['pad'] = 'x' * (args.payload_size - 60)
+    stop_sending = threading.Event()
+    with _Usage() as usage:
+        jitter = _drive([(template.sample_and_publish, (idx, sensor)) for idx, sensor in enumerate(sensors, 1)],
+                        args.rate, args.duration)
+        stop_sending.set()
+        if len(latency) < len(sent_t):
+            done.wait(5.0)
+    template.pipeline.publisher = supervisor
+    extra = {'jitter': jitter, 'trace': tracing.settings(), 'device_metrics': template.metrics.snapshot()['ack_ms'], 'pipeline': template.pipeline.stats()}
+    subscriber.disconnect()
+    subscriber.loop_stop()
+    unwire_template()
+    return _result('publish', args, len(sent_t), len(latency), latency, usage, extra)
+
+def bench_inbound(port, args):
+    """ Bench publisher -> broker -> template on_message -> inbound queue -> router -> handle_instructions.
+        Each payload carries its send time. Latency is send to handler finished """
+    wire_template(port, args.qos)
+    latency, lock = [], threading.Lock()
+
+    def probe(topic, payload):
+        now = perf_counter()
+        sent = json.loads(payload)['t']
+        with lock:
+            latency.append((now - sent) * 1000)
+    template.router.add(template.MQTT_SUB_TOPIC, probe)          # Runs after handle_instructions
+    sleep(0.2)
+
+    publisher = connect_client('bench-pub', port)
+    pad = 'x' * max(args.payload_size - 40, 0)
+    sent = [0]
+    def send(n):
+        publisher.publish(template.MQTT_SUB_TOPIC, json.dumps({'t': perf_counter(), 'n': sent[0], 'pad': pad}), args.qos)
+        sent[0] += 1
+    with _Usage() as usage:
+        _drive([(send, (n,)) for n in range(args.sensors)], args.rate, args.duration)
+        deadline = perf_counter() + 5.0
+        while len(latency) < sent[0] - template.inbound.dropped_oldest - template.inbound.dropped_newest and perf_counter() < deadline:
+            sleep(0.01)
+    extra = {'inbound': template.inbound.stats(), 'decode_us': template.metrics.snapshot()['in']['decode_us']}
+    publisher.disconnect()
+    publisher.loop_stop()
+    unwire_template()
+    return _result('inbound', args, sent[0], len(latency), latency, usage, extra)
+
+SCENARIOS = {'publish': bench_publish, 'inbound': bench_inbound}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark template.py against a local stand-in broker")
+    parser.add_argument('--mode', choices=sorted(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--sensors', type=int, default=2, help="demo sensors (publish) or publisher jobs (inbound)")
+    parser.add_argument('--rate', type=float, default=100.0, help="msgs/sec per sensor. 0 = as fast as possible")
+    parser.add_argument('--payload-size', type=int, default=0, help="approximate JSON payload bytes (padding)")
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--codec', default='json', help="payload codec for the publish scenario (see codec.py)")
+    parser.add_argument('--max-inflight', type=int, default=20, help="publish pipeline in-flight window")
+    parser.add_argument('--backpressure', choices=('block', 'drop', 'coalesce'), default='block',
+                        help="publish pipeline mode when the window is full")
+    parser.add_argument('--trace-every', type=int, default=0, help="trace 1 in N messages (stderr). 0 = off")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per scenario")
+    parser.add_argument('--output', help="append JSON results (one per line) to this file")
+    args = parser.parse_args(argv)
+
+    log_listener = tracing.setup_logging(logging.WARNING)   # Debug logging would dominate the measurement
+    tracing.configure(trace=args.trace_every > 0, every=max(args.trace_every, 1), per_sec=0)
+    port, stop_broker = start_broker()
+    results = []
+    try:
+        for mode in (sorted(SCENARIOS) if args.mode == 'all' else [args.mode]):
+            result = SCENARIOS[mode](port, args)
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        broker_stats = stop_broker()
+    logging.info("(bench) broker stats: {0}".format(broker_stats))
+    log_listener.stop()
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#====== PAYLOAD CODECS ==================#
+# Publishing json.dumps({'demoSensori': 1, 'sensorData1f': 23.0, 'sensorData2i': 7}) sends ~60 bytes
+# for three numbers. A StructCodec declares a fixed layout once (key + struct format per field) and
+# sends a 3 byte header + packed values instead (12 bytes for the demo sensor).
+# Header = magic (0xB5), schema version, schema id. 0xB5 can never start a JSON/UTF-8 text payload
+# so decode() can tell binary from JSON without knowing the topic.
+#     codec = get_codec('demo-sensor')      # or 'json'
+#     mqtt_client.publish(topic, codec.encode(outgoingD['data']))
+#     data = decode(msg.payload)            # in the handler. Works for both JSON and binary
+#     codec.encode_many([data1, data2])     # batch. decode() returns a list
+# A binary batch of one reading is byte for byte a single sample, so it decodes to a dict (the JSON
+# codec returns a one item list). Consumers of binary batches should accept both.
+# Run 'python3 codec.py' to print a size and speed comparison.
+
+import json, struct
+from time import perf_counter
+
+MAGIC = 0xB5
+HEADER = struct.Struct('<BBB')   # magic, version, schema id
+
+class CodecError(ValueError):
+    pass
+
+class JsonCodec:
+    """ The original format. Self describing, larger and slower """
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data).encode('utf-8')
+
+    def encode_many(self, items):
+        """ Batch of readings as one JSON list """
+        return json.dumps(items).encode('utf-8')
+
+    def decode(self, payload):
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode('utf-8', 'ignore')
+        return json.loads(payload)
+
+class StructCodec:
+    """ Fixed layout binary codec. fields = [(key, struct format char), ...] in wire order
+        Formats follow the struct module: 'B' uint8, 'h' int16, 'i' int32, 'f' float32, 'd' float64, ..."""
+
+    def __init__(self, name, schema_id, fields, version=1):
+        if not 0 <= schema_id <= 255 or not 0 <= version <= 255:
+            raise ValueError("schema_id and version must fit in one byte")
+        self.name = name
+        self.schema_id = schema_id
+        self.version = version
+        self.keys = tuple(key for key, _ in fields)
+        self.body = struct.Struct('<' + ''.join(fmt for _, fmt in fields))
+        self._header = HEADER.pack(MAGIC, version, schema_id)
+        self.size = HEADER.size + self.body.size
+
+    def encode(self, data):
+        try:
+            return self._header + self.body.pack(*[data[key] for key in self.keys])
+        except (KeyError, struct.error) as error:
+            raise CodecError("{0}: can not encode {1}: {2}".format(self.name, data, error))
+
+    def encode_many(self, items):
+        """ Batch of readings as back to back frames (header + body each). decode() returns a list for these,
+            except for a batch of one reading which can't be told apart from encode() and decodes to a dict """
+        return b''.join(self.encode(data) for data in items)
+
+    def _check_header(self, payload, offset=0):
+        magic, version, schema_id = HEADER.unpack_from(payload, offset)
+        if magic != MAGIC or schema_id != self.schema_id or version != self.version:
+            raise CodecError("{0}: payload header {1}/{2}/{3} at byte {4} does not match schema {5}/{6}".format(
+                self.name, magic, version, schema_id, offset, self.version, self.schema_id))
+
+    def decode(self, payload):
+        self._check_header(payload)
+        if len(payload) == self.size:
+            return dict(zip(self.keys, self.body.unpack_from(payload, HEADER.size)))
+        if len(payload) % self.size:
+            raise CodecError("{0}: expected a multiple of {1} bytes, got {2}".format(self.name, self.size, len(payload)))
+        items = []                                     # Batch (encode_many). Every frame carries its own header
+        for offset in range(0, len(payload), self.size):
+            if offset:
+                self._check_header(payload, offset)
+            items.append(dict(zip(self.keys, self.body.unpack_from(payload, offset + HEADER.size))))
+        return items
+
+#====== CODEC REGISTRY ==================#
+JSON = JsonCodec()
+_by_name = {JSON.name: JSON}
+_by_id = {}       # (schema_id, version) -> StructCodec
+
+def register(codec):
+    """ Make a StructCodec available to get_codec() and decode(). Returns the codec """
+    key = (codec.schema_id, codec.version)
+    if key in _by_id and _by_id[key] is not codec:
+        raise ValueError("schema id {0} version {1} already registered".format(*key))
+    _by_id[key] = codec
+    _by_name[codec.name] = codec
+    return codec
+
+def get_codec(name):
+    try:
+        return _by_name[name]
+    except KeyError:
+        raise ValueError("unknown codec {0}. Choose from {1}".format(name, sorted(_by_name)))
+
+def decode(payload):
+    """ Decode any registered format. Binary payloads are recognized by the magic byte, everything else is JSON """
+    if isinstance(payload, (bytes, bytearray)) and len(payload) >= HEADER.size and payload[0] == MAGIC:
+        _, version, schema_id = HEADER.unpack_from(payload)
+        codec = _by_id.get((schema_id, version))
+        if codec is None:
+            raise CodecError("no schema registered for id {0} version {1}".format(schema_id, version))
+        return codec.decode(payload)
+    return JSON.decode(payload)
+
+# Schema for DemoSensor data in template.py. sensorData1f is sent as float32.
+DEMO_SENSOR = register(StructCodec('demo-sensor', 1, [('demoSensori', 'B'), ('sensorData1f', 'f'), ('sensorData2i', 'i')]))
+
+#====== COMPARISON ======================#
+def compare(data, codecs=None, n=20000):
+    """ Payload size (bytes) and encode/decode time (microseconds) per codec """
+    results = {}
+    for codec in codecs or list(_by_name.values()):
+        payload = codec.encode(data)
+        t0 = perf_counter()
+        for _ in range(n):
+            codec.encode(data)
+        t1 = perf_counter()
+        for _ in range(n):
+            codec.decode(payload)
+        t2 = perf_counter()
+        results[codec.name] = {'bytes': len(payload),
+                               'encode_us': round((t1 - t0) / n * 1e6, 3),
+                               'decode_us': round((t2 - t1) / n * 1e6, 3)}
+    return results
+
+if __name__ == "__main__":
+    sample = {'demoSensori': 1, 'sensorData1f': 23.0, 'sensorData2i': 7}
+    for name, result in compare(sample).items():
+        print("{0:12} {1:4} bytes  encode {2:7.3f} us  decode {3:7.3f} us".format(
+            name, result['bytes'], result['encode_us'], result['decode_us']))
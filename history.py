@@ -0,0 +1,162 @@
+#====== SENSOR HISTORY ==================#
+# Keeps the recent readings of one sensor on the device so consumers can backfill after an outage
+# without a central database. Fixed memory budget: one typed array per field plus one array of
+# timestamp deltas, all preallocated. Once full the oldest reading is overwritten.
+# Timestamps are delta encoded: uint32 milliseconds since the previous reading (4 bytes instead of
+# an 8 byte float). The absolute time of the oldest reading is kept so the rest can be rebuilt.
+# DemoSensor record = 4 (delta) + 4 (sensorData1f float32) + 4 (sensorData2i int32) = 12 bytes,
+# so a 64 KB budget holds ~5400 readings (4.5 hours at one reading every 3 sec).
+#     history = SensorHistory((('sensorData1f', 'f'), ('sensorData2i', 'i')), budget=64 * 1024)
+#     history.append(time(), outgoingD['data'])
+#     history.query(t_from, t_to)              # every reading in the range
+#     history.query(t_from, t_to, step=60)     # one mean/min/max per 60 sec bucket
+# float32 ('f') columns are replied rounded to 7 significant digits (float32 precision), so a
+# published 23.1 reads back as 23.1 and not 23.100000381469727.
+
+import math, threading
+from array import array
+
+MAX_DELTA_MS = 0xFFFFFFFF        # uint32. ~49 days between readings
+
+def _float32(value):
+    return float('{0:.7g}'.format(value))
+
+class SensorHistory:
+    """ fields = ((key, array typecode), ...) ie 'f' float32, 'd' float64, 'i' int32, 'h' int16, 'B' uint8 """
+    __slots__ = ('fields', 'capacity', 'count', '_i', '_dt', '_columns', '_ints', '_out', '_first_ms', '_last_ms', '_lock')
+
+    def __init__(self, fields, budget=64 * 1024):
+        self.fields = tuple(key for key, _ in fields)
+        record = array('I').itemsize + sum(array(typecode).itemsize for _, typecode in fields)
+        self.capacity = budget // record
+        if self.capacity < 2:
+            raise ValueError("history budget {0} bytes holds less than 2 readings of {1} bytes".format(budget, record))
+        self.count = 0
+        self._i = 0                       # Next write position
+        self._dt = array('I', bytes(array('I').itemsize * self.capacity))
+        self._columns = tuple(array(typecode, bytes(array(typecode).itemsize * self.capacity)) for _, typecode in fields)
+        self._ints = tuple(column.typecode not in 'fd' for column in self._columns)
+        self._out = tuple(_float32 if column.typecode == 'f' else None for column in self._columns)   # Reply conversion
+        self._first_ms = 0                # Epoch ms of the oldest reading
+        self._last_ms = 0                 # Epoch ms of the newest reading
+        self._lock = threading.Lock()     # Appends come from the sampler, queries from an inbound worker
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in (self._dt,) + self._columns)
+
+    def append(self, t, sample):
+        """ t = epoch seconds. A clock stepping backwards is stored as a 0 delta """
+        ms = round(t * 1000)
+        with self._lock:
+            i = self._i
+            if not self.count:
+                self._first_ms = self._last_ms = ms
+                dt = 0
+            else:
+                dt = min(max(ms - self._last_ms, 0), MAX_DELTA_MS)
+                self._last_ms += dt
+            if self.count == self.capacity:
+                self._first_ms += self._dt[(i + 1) % self.capacity]    # The next reading becomes the oldest
+            else:
+                self.count += 1
+            self._dt[i] = dt
+            for column, is_int, key in zip(self._columns, self._ints, self.fields):
+                column[i] = int(sample[key]) if is_int else sample[key]
+            self._i = (i + 1) % self.capacity
+
+    def _readings(self, from_ms, to_ms):
+        """ (epoch ms, position) oldest first within [from_ms, to_ms]. Call with the lock held """
+        start = (self._i - self.count) % self.capacity
+        ms = self._first_ms
+        for k in range(self.count):
+            pos = (start + k) % self.capacity
+            if k:
+                ms += self._dt[pos]
+            if ms > to_ms:
+                return
+            if ms >= from_ms:
+                yield ms, pos
+
+    def query(self, t_from=None, t_to=None, step=None, limit=None, skip=0):
+        """ Readings with t_from <= t <= t_to (epoch seconds, None = open ended), oldest first, columnar:
+            {'t': [...], key: [...], ...}. With step (seconds) readings are grouped into buckets starting at
+            t_from (or the first reading) and each bucket is {'t': bucket start, 'n', key: [mean, min, max]}.
+            limit caps the rows returned. 'next' (and for raw readings 'skip') then continue the query:
+            query(next, t_to, step, limit, skip). skip = readings at exactly t_from already returned, so
+            paging works when more than limit readings share one millisecond (ie after a clock step back) """
+        for name, value in (('from', t_from), ('to', t_to), ('step', step)):
+            if value is not None and not math.isfinite(value):      # json.loads accepts 1e400 (inf) and NaN
+                raise ValueError("{0} must be a finite number (got {1})".format(name, value))
+        if step is not None and step <= 0:
+            raise ValueError("step must be > 0 (got {0})".format(step))
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be >= 1 (got {0})".format(limit))
+        from_ms = -math.inf if t_from is None else round(t_from * 1000)
+        to_ms = math.inf if t_to is None else round(t_to * 1000)
+        with self._lock:
+            if step is None:
+                return self._raw(from_ms, to_ms, limit, skip)
+            return self._downsample(from_ms, to_ms, step * 1000, limit)
+
+    def _raw(self, from_ms, to_ms, limit, skip):
+        result = {'t': []}
+        result.update((key, []) for key in self.fields)
+        rows = result['t']
+        last_ms, run = None, 0          # Readings at last_ms so far (including skipped ones)
+        for ms, pos in self._readings(from_ms, to_ms):
+            run = run + 1 if ms == last_ms else 1
+            last_ms = ms
+            if ms == from_ms and run <= skip:
+                continue
+            if limit is not None and len(rows) >= limit:
+                result['next'] = ms / 1000
+                if run > 1:
+                    result['skip'] = run - 1
+                break
+            rows.append(ms / 1000)
+            for column, out, key in zip(self._columns, self._out, self.fields):
+                result[key].append(column[pos] if out is None else out(column[pos]))
+        return result
+
+    def _downsample(self, from_ms, to_ms, step_ms, limit):
+        result = {'t': [], 'n': []}
+        result.update((key, []) for key in self.fields)
+        bucket = origin = None
+        acc = None                      # Per field [sum, min, max] for the open bucket
+        for ms, pos in self._readings(from_ms, to_ms):
+            if origin is None:
+                origin = ms if from_ms == -math.inf else from_ms
+            b = int((ms - origin) // step_ms)
+            if b != bucket:
+                if bucket is not None:
+                    self._close_bucket(result, origin + bucket * step_ms, n, acc)
+                if limit is not None and len(result['t']) >= limit:
+                    result['next'] = (origin + b * step_ms) / 1000
+                    return result
+                bucket, n = b, 0
+                acc = [[0.0, math.inf, -math.inf] for _ in self.fields]
+            n += 1
+            for column, a in zip(self._columns, acc):
+                v = column[pos]
+                a[0] += v
+                if v < a[1]:
+                    a[1] = v
+                if v > a[2]:
+                    a[2] = v
+        if bucket is not None:
+            self._close_bucket(result, origin + bucket * step_ms, n, acc)
+        return result
+
+    def _close_bucket(self, result, start_ms, n, acc):
+        result['t'].append(start_ms / 1000)
+        result['n'].append(n)
+        for key, out, (total, low, high) in zip(self.fields, self._out, acc):
+            result[key].append([total / n, low, high] if out is None else [out(total / n), out(low), out(high)])
+
+    def stats(self):
+        return {'count': self.count, 'capacity': self.capacity, 'bytes': self.nbytes,
+                'span_sec': round((self._last_ms - self._first_ms) / 1000, 3) if self.count else 0.0}
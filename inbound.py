@@ -0,0 +1,118 @@
+#====== INBOUND MESSAGE QUEUE ===========#
+# on_message runs on paho's network thread. Anything slow in it (json decode, user handlers)
+# delays keepalives and every other message. The network thread only calls put() with the raw
+# topic/payload and a small pool of worker threads runs the handler.
+# The queue is bounded. When full the overflow policy decides what happens:
+#   'drop-oldest'  = discard the oldest queued message (keep the newest instructions)
+#   'drop-newest'  = discard the incoming message
+#   'block'        = block the caller (paho network thread) until there is room or put timeout
+
+import logging, threading
+from collections import deque
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+class InboundQueue:
+    """ Bounded, thread-safe queue of (topic, payload) with a worker pool calling handler(topic, payload)
+        inbound = InboundQueue(handler, maxsize=256, policy='drop-oldest', workers=2)
+        inbound.start()
+        inbound.put(msg.topic, msg.payload)   # from on_message
+    """
+
+    def __init__(self, handler, maxsize=256, policy=DROP_OLDEST, workers=1, block_timeout=None):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of {0} (got {1})".format(POLICIES, policy))
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1 (got {0})".format(maxsize))
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout   # Only used with 'block'. None waits forever
+        self.nworkers = workers
+        self._q = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._threads = []
+        self._running = False
+        # Counters (read with stats())
+        self.received = 0         # put() calls
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.handled = 0
+        self.errors = 0           # handler raised
+        self.high_water = 0       # max depth seen
+
+    def start(self):
+        self._running = True
+        for n in range(self.nworkers):
+            t = threading.Thread(target=self._worker, name="inbound-{0}".format(n), daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, timeout=None):
+        """ Stop the workers. Messages still queued are discarded """
+        with self._lock:
+            self._running = False
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def put(self, topic, payload):
+        """ Enqueue a raw message. Returns False if the message (this one) was dropped """
+        with self._lock:
+            self.received += 1
+            if len(self._q) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped_newest += 1
+                    return False
+                elif self.policy == DROP_OLDEST:
+                    self._q.popleft()
+                    self.dropped_oldest += 1
+                else:
+                    if not self._not_full.wait_for(lambda: len(self._q) < self.maxsize or not self._running,
+                                                   self.block_timeout):
+                        self.dropped_newest += 1   # Timed out waiting for room
+                        return False
+            self._q.append((topic, payload))
+            depth = len(self._q)
+            if depth > self.high_water:
+                self.high_water = depth
+            self._not_empty.notify()
+        return True
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                while not self._q and self._running:
+                    self._not_empty.wait()
+                if not self._running:
+                    return
+                topic, payload = self._q.popleft()
+                self._not_full.notify()
+            try:
+                self.handler(topic, payload)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                logging.exception("(inbound) handler failed for topic {0}".format(topic))
+            else:
+                with self._lock:
+                    self.handled += 1
+
+    @property
+    def depth(self):
+        return len(self._q)
+
+    def stats(self):
+        with self._lock:
+            return {'depth': len(self._q), 'maxsize': self.maxsize, 'policy': self.policy,
+                    'received': self.received, 'handled': self.handled, 'errors': self.errors,
+                    'dropped_oldest': self.dropped_oldest, 'dropped_newest': self.dropped_newest,
+                    'high_water': self.high_water}
@@ -0,0 +1,241 @@
+#====== VIRTUAL DEVICE LOAD GENERATOR ===#
+# Simulates N hosts x M DemoSensors against a broker, to see how the broker and downstream consumers
+# cope with thousands of devices like template.py. Each virtual host is its own mqtt.Client with a
+# unique client id and publishes the same topic and payload shape as template.py (demo/sensor/data,
+# {'demoSensori', 'sensorData1f', 'sensorData2i'}, JSON or a codec.py binary schema).
+# Hosts are split across worker processes. Inside a process every connection is driven by one
+# asyncio event loop (aioruntime.AsyncClient, no thread per client) and each sensor is a task.
+# Rate profiles (messages/sec per sensor over the run):
+#   'constant' = rate                     'ramp'  = 0 -> rate over the duration
+#   'step'     = 25%, 50%, 75%, 100%      'burst' = rate, 10x rate for 1 sec every 10 sec
+#     python3 loadgen.py --local --hosts 1000 --sensors 2 --processes 4 --rate 1 --duration 30
+#     python3 loadgen.py --broker rpi3mqtt1.local:1883 --hosts 200 --profile ramp --rate 5
+# Prints one JSON result (target vs achieved msgs/sec, connect and publish latency, broker stats with --local).
+
+import argparse, asyncio, json, logging, math, os, random, resource, socket, threading
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, sleep
+import paho.mqtt.client as mqtt
+
+import codec
+from aioruntime import AsyncClient
+from metrics import Histogram
+from template import read_demo_sensor
+
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+MIN_RATE = 0.01          # msgs/sec. Avoids dividing by a zero rate (ramp start)
+MAX_SLEEP = 0.5          # A sensor re-checks the profile rate at least this often (sec)
+
+#====== RATE PROFILES ===================#
+PROFILES = {
+    'constant': lambda t, rate, duration: rate,
+    'ramp':     lambda t, rate, duration: rate * min(t / duration, 1.0),
+    'step':     lambda t, rate, duration: rate * min(int(t * 4 / duration) + 1, 4) / 4,
+    'burst':    lambda t, rate, duration: rate * 10 if t % 10 < 1 else rate,
+}
+
+def target_messages(profile, rate, duration, sensors, step=0.01):
+    """ Messages the profile asks for over the run (all sensors) """
+    func = PROFILES[profile]
+    return sensors * math.fsum(func(k * step, rate, duration) * step for k in range(int(duration / step)))
+
+#====== WORKER PROCESS ==================#
+def raise_fd_limit():
+    """ Every connection is a file descriptor. Raise the soft limit to the hard limit """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+class _WorkerStats:
+
+    def __init__(self):
+        self.connected = 0
+        self.connect_errors = 0
+        self.sent = 0
+        self.errors = 0
+        self.late = 0                    # Sends skipped because the sensor fell behind schedule
+        self.connect_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.publish_ms = Histogram(LATENCY_BUCKETS_MS)   # publish call to ack (qos 1) or written (qos 0)
+
+async def _connect(host_id, opts, stats):
+    client = mqtt.Client("{0}-{1:05d}".format(opts['prefix'], host_id))
+    aclient = AsyncClient(client, min_delay=1.0, max_delay=30.0, connect_timeout=opts['connect_timeout'])
+    t0 = perf_counter()
+    try:
+        await asyncio.wait_for(aclient.connect(opts['host'], opts['port']), opts['connect_timeout'])
+    except (OSError, asyncio.TimeoutError) as error:
+        stats.connect_errors += 1
+        logging.debug("(load) host {0} connect failed: {1}".format(host_id, error))
+        await aclient.disconnect()
+        return None
+    stats.connect_ms.add((perf_counter() - t0) * 1000)
+    stats.connected += 1
+    return aclient
+
+async def _sensor(aclient, idx, start, opts, stats):
+    """ One virtual DemoSensor. Integrates the profile rate (credit += rate * dt) and publishes at every whole
+        credit, so changing rates are followed exactly. Random starting credit so hosts don't publish in lockstep """
+    loop = asyncio.get_running_loop()
+    rate_at, rate, duration = PROFILES[opts['profile']], opts['rate'], opts['duration']
+    payload_codec = codec.get_codec(opts['codec'])
+    end = start + duration
+    credit, t_prev = random.random(), start
+    while True:
+        now = loop.time()
+        if now >= end:
+            return
+        credit += rate_at(t_prev - start, rate, duration) * (now - t_prev)   # Rate the sleep was planned with
+        t_prev = now
+        r = rate_at(now - start, rate, duration)
+        if credit < 1.0:
+            await asyncio.sleep(min((1.0 - credit) / max(r, MIN_RATE), end - now, MAX_SLEEP))
+            continue
+        if credit >= 2.0:                                  # Fell behind (slow acks). Skip, no burst to catch up
+            stats.late += int(credit) - 1
+            credit = 1.0
+        credit -= 1.0
+        sensorData1, sensorData2 = read_demo_sensor()
+        data = {'demoSensori': idx, 'sensorData1f': sensorData1, 'sensorData2i': sensorData2}
+        t0 = perf_counter()
+        try:
+            await aclient.publish(opts['topic'], payload_codec.encode(data), opts['qos'])
+        except ConnectionError:
+            stats.errors += 1
+            continue
+        stats.sent += 1
+        stats.publish_ms.add((perf_counter() - t0) * 1000)
+
+async def _worker(host_ids, opts):
+    loop = asyncio.get_running_loop()
+    stats = _WorkerStats()
+    t0 = perf_counter()
+    interval = 1.0 / opts['connect_rate'] if opts['connect_rate'] else 0.0
+    connecting = []
+    for n, host_id in enumerate(host_ids):          # Stagger connects so the broker isn't hit by all at once
+        connecting.append(loop.create_task(_connect(host_id, opts, stats)))
+        if interval:
+            await asyncio.sleep(interval)
+    clients = [c for c in await asyncio.gather(*connecting) if c is not None]
+    connect_sec = perf_counter() - t0
+    start = loop.time()
+    t1 = perf_counter()
+    await asyncio.gather(*(_sensor(aclient, idx, start, opts, stats)
+                           for aclient in clients for idx in range(1, opts['sensors'] + 1)))
+    publish_sec = perf_counter() - t1
+    for aclient in clients:
+        await aclient.disconnect()
+    await asyncio.sleep(0.1)                          # Let the DISCONNECT packets go out
+    return stats, connect_sec, publish_sec
+
+def run_worker(host_ids, opts):
+    """ Entry point of one worker process. Returns (stats, connect_sec, publish_sec) """
+    logging.basicConfig(level=opts['log_level'])
+    if raise_fd_limit() < len(host_ids) + 64:
+        logging.info("(load) fd limit is below {0} connections. Use more --processes".format(len(host_ids)))
+    return asyncio.run(_worker(host_ids, opts))
+
+#====== SUBSCRIBER (OPTIONAL) ===========#
+class _Counter:
+    """ Counts deliveries on the load topic. What downstream consumers would see """
+
+    def __init__(self, host, port, topic, qos):
+        self.received = 0
+        connected = threading.Event()
+        self.client = mqtt.Client("{0}-counter".format(os.getpid()))
+        self.client.on_connect = lambda c, u, f, rc: (c.subscribe(topic, qos), connected.set())
+        self.client.on_message = self._on_message
+        self.client.connect(host, port)
+        self.client.loop_start()
+        if not connected.wait(5.0):
+            raise RuntimeError("(load) counter could not connect to {0}:{1}".format(host, port))
+        sleep(0.2)                     # SUBACK
+
+    def _on_message(self, client, userdata, msg):
+        self.received += 1
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+#====== MAIN ============================#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate N hosts x M DemoSensors publishing like template.py")
+    parser.add_argument('--broker', default='127.0.0.1:1883', help="host:port of the broker under test")
+    parser.add_argument('--local', action='store_true', help="start the local stand-in broker (localbroker.py) instead")
+    parser.add_argument('--hosts', type=int, default=100, help="virtual hosts (one mqtt client each)")
+    parser.add_argument('--sensors', type=int, default=2, help="DemoSensors per host")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='constant')
+    parser.add_argument('--rate', type=float, default=1.0, help="msgs/sec per sensor (profile peak for ramp/step)")
+    parser.add_argument('--duration', type=float, default=30.0, help="publish seconds, after all hosts connected")
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--codec', default='json', help="payload codec (see codec.py), ie demo-sensor")
+    parser.add_argument('--topic', default='demo/sensor/data')
+    parser.add_argument('--prefix', default='load', help="client ids are <prefix>-<host number>")
+    parser.add_argument('--connect-rate', type=float, default=500.0, help="new connections/sec in total. 0 = all at once")
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    parser.add_argument('--subscribe', action='store_true', help="also count deliveries with a subscriber")
+    parser.add_argument('--output', help="append the JSON result to this file")
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args(argv)
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(level=log_level)
+    codec.get_codec(args.codec)                       # Fail early on a bad codec name
+    stop_broker = None
+    if args.local:
+        from benchmark import start_broker
+        port, stop_broker = start_broker()
+        host = '127.0.0.1'
+    else:
+        host, _, port = args.broker.rpartition(':')
+        host, port = host or args.broker, int(port or 1883)
+    host = socket.gethostbyname(host)                 # Resolve once, not once per virtual host
+    processes = max(1, min(args.processes, args.hosts))
+    opts = {'host': host, 'port': port, 'prefix': args.prefix, 'sensors': args.sensors, 'profile': args.profile,
+            'rate': args.rate, 'duration': args.duration, 'qos': args.qos, 'codec': args.codec, 'topic': args.topic,
+            'connect_rate': args.connect_rate / processes, 'connect_timeout': args.connect_timeout, 'log_level': log_level}
+    logging.info("(load) {0} hosts x {1} sensors, {2} processes, {3} profile at {4} msgs/sec per sensor -> {5}:{6}".format(
+        args.hosts, args.sensors, processes, args.profile, args.rate, host, port))
+
+    counter = _Counter(host, port, args.topic, args.qos) if args.subscribe else None
+    try:
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(run_worker, list(range(n, args.hosts, processes)), opts) for n in range(processes)]
+            results = [f.result() for f in futures]
+        if counter is not None:
+            sleep(1.0)                 # Deliveries still in flight
+    finally:
+        if counter is not None:
+            counter.stop()
+        broker_stats = stop_broker() if stop_broker is not None else None
+
+    stats = _WorkerStats()
+    for worker, _, _ in results:
+        for name in ('connected', 'connect_errors', 'sent', 'errors', 'late'):
+            setattr(stats, name, getattr(stats, name) + getattr(worker, name))
+        stats.connect_ms.merge(worker.connect_ms)
+        stats.publish_ms.merge(worker.publish_ms)
+    publish_sec = max(r[2] for r in results)
+    target = target_messages(args.profile, args.rate, args.duration, stats.connected * args.sensors)
+    result = {'hosts': args.hosts, 'sensors': args.sensors, 'processes': processes, 'profile': args.profile,
+              'rate': args.rate, 'qos': args.qos, 'codec': args.codec, 'duration': round(publish_sec, 3),
+              'connected': stats.connected, 'connect_errors': stats.connect_errors,
+              'connect_sec': round(max(r[1] for r in results), 3),
+              'target_msgs': int(target), 'sent': stats.sent, 'errors': stats.errors, 'late': stats.late,
+              'target_msgs_per_sec': round(target / args.duration, 1),
+              'msgs_per_sec': round(stats.sent / publish_sec, 1) if publish_sec else 0.0,
+              'connect_ms': stats.connect_ms.summary(), 'publish_ms': stats.publish_ms.summary()}
+    if counter is not None:
+        result['received'] = counter.received
+    if broker_stats is not None:
+        result['broker'] = broker_stats
+    print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    return result
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#====== LOCAL STAND-IN BROKER ===========#
+# Minimal MQTT 3.1.1 broker for benchmarks and load tests on localhost. NOT for production.
+# Supports CONNECT (any user/password accepted), PUBLISH QoS 0/1 (QoS 2 is acknowledged and
+# forwarded as QoS 1), SUBSCRIBE/UNSUBSCRIBE with + and # wildcards (granted QoS max 1),
+# PINGREQ and DISCONNECT. No retained messages, no persistent sessions, no will messages.
+#     broker = LocalBroker(port=0).start()     # background thread, port 0 picks a free port
+#     client.connect('127.0.0.1', broker.port)
+#     broker.stop()
+# Or as a script: python3 localbroker.py --port 1883
+
+import argparse, asyncio, logging, struct, threading
+from router import TopicRouter
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+def packet(ptype, flags, body):
+    return bytes([(ptype << 4) | flags]) + encode_length(len(body)) + body
+
+def utf8(data, pos):
+    """ Read an MQTT length-prefixed string. Returns (str, new position) """
+    n = struct.unpack_from('!H', data, pos)[0]
+    return data[pos + 2:pos + 2 + n].decode('utf-8'), pos + 2 + n
+
+class _Session:
+
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.client_id = None
+        self.filters = {}         # filter -> _Subscription
+        self._pid = 0
+
+    def next_pid(self):
+        self._pid = self._pid % 65535 + 1
+        return self._pid
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+class _Subscription:
+    __slots__ = ('session', 'qos')
+
+    def __init__(self, session, qos):
+        self.session = session
+        self.qos = qos
+
+class LocalBroker:
+
+    def __init__(self, host='127.0.0.1', port=1883):
+        self.host = host
+        self.port = port
+        self.router = TopicRouter(cache_size=4096)
+        self.sessions = set()
+        self.received = 0         # PUBLISH packets in
+        self.delivered = 0        # PUBLISH packets out
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    #==== RUNNING ======================#
+    async def serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info("(broker) listening on {0}:{1}".format(self.host, self.port))
+        self._ready.set()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start(self):
+        """ Run in a background (daemon) thread. Returns once the port is bound """
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.serve())
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self._loop.close()
+        self._thread = threading.Thread(target=run, name="local-broker", daemon=True)
+        self._thread.start()
+        self._ready.wait(5.0)
+        return self
+
+    def stop(self):
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._shutdown)
+        if self._thread is not None:
+            self._thread.join(5.0)
+
+    def _shutdown(self):
+        for session in list(self.sessions):
+            session.writer.close()     # Client handlers end with IncompleteReadError
+        self._server.close()           # Cancels serve_forever()
+
+    def stats(self):
+        return {'sessions': len(self.sessions), 'received': self.received, 'delivered': self.delivered}
+
+    #==== PROTOCOL =====================#
+    async def _handle(self, reader, writer):
+        session = _Session(self, writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b''
+                if not self._packet(session, header[0] >> 4, header[0] & 0x0F, body):
+                    break
+                if writer.transport.get_write_buffer_size() > 1024 * 1024:
+                    await writer.drain()       # Slow subscriber. Stop reading this client until it catches up
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            for topic_filter, sub in session.filters.items():
+                self.router.remove(topic_filter, sub)
+            writer.close()
+
+    def _packet(self, session, ptype, flags, body):
+        """ Handle one packet. Returns False to close the connection """
+        if ptype == PUBLISH:
+            self._publish(session, flags, body)
+        elif ptype == CONNECT:
+            _, pos = utf8(body, 0)              # Protocol name
+            session.client_id, _ = utf8(body, pos + 4)    # Skip level, flags, keepalive
+            session.send(packet(CONNACK, 0, b'\x00\x00'))
+        elif ptype == PUBREL:
+            session.send(packet(PUBCOMP, 0, body[:2]))
+        elif ptype == SUBSCRIBE:
+            pid, pos = body[:2], 2
+            granted = bytearray()
+            while pos < len(body):
+                topic_filter, pos = utf8(body, pos)
+                qos = min(body[pos], 1)
+                pos += 1
+                old = session.filters.pop(topic_filter, None)
+                if old is not None:
+                    self.router.remove(topic_filter, old)
+                sub = session.filters[topic_filter] = _Subscription(session, qos)
+                self.router.add(topic_filter, sub, qos)
+                granted.append(qos)
+            session.send(packet(SUBACK, 0, pid + bytes(granted)))
+        elif ptype == UNSUBSCRIBE:
+            pos = 2
+            while pos < len(body):
+                topic_filter, pos = utf8(body, pos)
+                sub = session.filters.pop(topic_filter, None)
+                if sub is not None:
+                    self.router.remove(topic_filter, sub)
+            session.send(packet(UNSUBACK, 0, body[:2]))
+        elif ptype == PINGREQ:
+            session.send(packet(PINGRESP, 0, b''))
+        elif ptype == DISCONNECT:
+            return False
+        return True        # PUBACK/PUBREC/PUBCOMP from subscribers need no action
+
+    def _publish(self, session, flags, body):
+        self.received += 1
+        qos = (flags >> 1) & 0x03
+        topic, pos = utf8(body, 0)
+        if qos:
+            pid = body[pos:pos + 2]
+            pos += 2
+            session.send(packet(PUBACK if qos == 1 else PUBREC, 0, pid))
+        payload = body[pos:]
+        topic_b = struct.pack('!H', len(topic.encode('utf-8'))) + topic.encode('utf-8')
+        plain = None
+        for sub in self.router.match(topic):
+            if min(qos, sub.qos):
+                out = packet(PUBLISH, 0x02, topic_b + struct.pack('!H', sub.session.next_pid()) + payload)
+            else:
+                plain = plain or packet(PUBLISH, 0, topic_b + payload)   # Same bytes for every QoS 0 subscriber
+                out = plain
+            sub.session.send(out)
+            self.delivered += 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimal local MQTT 3.1.1 broker stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(LocalBroker(args.host, args.port).serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,141 @@
+#====== RUNTIME METRICS =================#
+# Counters and a fixed-size latency histogram updated from the hot paths (publish, on_publish,
+# on_message). Each update is a couple of integer adds under a short lock, no allocation.
+# snapshot() turns them into a compact dict (rates are per second since the previous snapshot)
+# that the main loop publishes every few seconds on MQTT_PUB_RPI_TOPIC + '/metrics'.
+#     info = mqtt_client.publish(...)
+#     metrics.publish_sent(info.mid)
+#     metrics.publish_acked(mid)                 # in on_publish
+#     metrics.add_source('reconnects', lambda: supervisor.reconnects)
+
+import threading
+from time import perf_counter
+
+# Latency histogram bucket upper bounds in milliseconds (last bucket is everything larger)
+BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Histogram:
+    """ Fixed buckets, constant memory. Quantiles are estimated as the bucket upper bound, capped at
+        the largest value seen (a bound can be far above every sample in its bucket) """
+
+    def __init__(self, bounds=BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        for n, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            n = len(self.bounds)
+        self.counts[n] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add the counts of another histogram with the same bounds (ie one per worker process) """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for n, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return min(self.bounds[n], self.max) if n < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {'n': self.count, 'mean': round(self.total / self.count, 3) if self.count else 0.0,
+                'p50': round(self.quantile(0.5), 3), 'p90': round(self.quantile(0.9), 3), 'p99': round(self.quantile(0.99), 3),
+                'max': round(self.max, 3), 'hist': list(self.counts)}
+
+class Metrics:
+
+    def __init__(self, max_tracked=1024):
+        self._lock = threading.Lock()
+        self.max_tracked = max_tracked   # Cap on tracked in-flight mids (lost acks must not grow memory)
+        self._inflight = {}              # mid -> perf_counter() at publish
+        self._early = set()              # Acks that arrived before publish() returned the mid
+        self.ack_ms = Histogram()
+        self.published = 0
+        self.acked = 0
+        self.received = 0
+        self.decoded = 0
+        self.decode_sec = 0.0
+        self._sources = {}
+        self._t0 = self._last_t = perf_counter()
+        self._last_published = self._last_received = 0
+
+    def publish_sent(self, mid):
+        now = perf_counter()
+        with self._lock:
+            self.published += 1
+            if mid in self._early:
+                self._early.discard(mid)
+                self.acked += 1
+                self.ack_ms.add(0.0)
+                return
+            if len(self._inflight) >= self.max_tracked:
+                self._inflight.pop(next(iter(self._inflight)))   # Forget the oldest
+            self._inflight[mid] = now
+
+    def publish_acked(self, mid):
+        now = perf_counter()
+        with self._lock:
+            t = self._inflight.pop(mid, None)
+            if t is None:
+                if len(self._early) < self.max_tracked:
+                    self._early.add(mid)
+                return
+            self.acked += 1
+            self.ack_ms.add((now - t) * 1000)
+
+    def clear_inflight(self):
+        """ Call on disconnect. Acks for those mids will never arrive """
+        with self._lock:
+            self._inflight.clear()
+            self._early.clear()
+
+    def message_received(self):
+        with self._lock:
+            self.received += 1
+
+    def message_decoded(self, seconds):
+        with self._lock:
+            self.decoded += 1
+            self.decode_sec += seconds
+
+    def add_source(self, name, func):
+        """ Include func() in every snapshot, ie reconnect count or scheduler jitter """
+        self._sources[name] = func
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    def snapshot(self):
+        now = perf_counter()
+        with self._lock:
+            elapsed = (now - self._last_t) or 1e-9
+            snap = {'uptime': round(now - self._t0, 1),
+                    'pub': {'total': self.published, 'rate': round((self.published - self._last_published) / elapsed, 2),
+                            'inflight': len(self._inflight), 'acked': self.acked},
+                    'ack_ms': self.ack_ms.summary(),
+                    'in': {'total': self.received, 'rate': round((self.received - self._last_received) / elapsed, 2),
+                           'decode_us': round(self.decode_sec / self.decoded * 1e6, 1) if self.decoded else 0.0}}
+            self._last_t, self._last_published, self._last_received = now, self.published, self.received
+        for name, func in self._sources.items():
+            snap[name] = func()
+        return snap
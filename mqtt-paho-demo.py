@@ -10,13 +10,14 @@
 # To capture installed packages into a txt file
 # $ pip3 freeze > requirements.txt
 
-from time import sleep, perf_counter
+from time import sleep
 import logging, random, os
 import paho.mqtt.client as mqtt  # used for mqtt
 import sys, socket, json                 # Used for mqtt
 #from os import path              # Used for mqtt
 from pathlib import Path         # Used for mqtt
 from subprocess import check_output # alternate method to see IP address
+from scheduler import Scheduler  # Sleeps until the next deadline instead of busy-waiting
 
 #====== IP ADDRESS CHECK ==============#
 # Getting IP address. IP address will change over time and if Pi is offline vs online. 
@@ -101,6 +102,12 @@ def get_login_info(file):
         user_info = f.read().splitlines()
     return user_info
 
+def publish_data():
+    """ Scheduled job. Collect data and publish """
+    outgoingD['data']['item1'] = random.randrange(1, 50, 1)
+    outgoingD['data']['item2'] = random.randrange(1, 50, 1)
+    mqtt_client.publish(MQTT_PUB_TOPIC, json.dumps(outgoingD))  # publish data
+
 def main():
     ''' define global variables '''
     global mqtt_client, mqtt_newmsg, outgoingD, incomingD
@@ -172,18 +179,18 @@ def main():
     #==== MAIN LOOP ====================#
     # MQTT setup is successful. Start the main loop.
     mqtt_newmsg = False
-    t0_sec = perf_counter()
     msginterval = 3.0  # Adjust for how often data should be collected.
     outgoingD, incomingD = {}, {}
     outgoingD['description'] = 'This is a demo'
     outgoingD['data'] = {}
 
-    while True:
-        if (perf_counter() - t0_sec) > msginterval:
-            t0_sec = perf_counter()
-            outgoingD['data']['item1'] = random.randrange(1, 50, 1)
-            outgoingD['data']['item2'] = random.randrange(1, 50, 1)
-            mqtt_client.publish(MQTT_PUB_TOPIC, json.dumps(outgoingD))  # publish data
+    scheduler = Scheduler()  # Sleeps until the next deadline (fixed rate) instead of spinning a core
+    scheduler.every(msginterval, publish_data)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logging.info("Pressed ctrl-C")
+        logging.info("(sched) jitter stats: {0}".format(scheduler.stats()))
 
 if __name__ == "__main__":     # Will run main() code when program is executed as a script (vs imported as a module)
     main()
\ No newline at end of file
@@ -0,0 +1,47 @@
+#====== FAST NETWORK CHECK ==============#
+# In-process replacement for check_connection()/get_ipGP(). No fixed sleeps and no subprocesses
+# ('ip -j -4 route', 'hostname -I'). The interface address is read with an ioctl (Linux) and the
+# check polls every 'poll' seconds until the interface has an address or 'timeout' runs out,
+# so a device that is already online continues in a few milliseconds. An optional 'until' check
+# ends the wait early, ie once the broker connected (proof enough the network is up).
+
+import socket, struct, sys
+from time import sleep, perf_counter
+
+SIOCGIFADDR = 0x8915   # Linux ioctl: get interface IPv4 address
+
+def get_ip(ifname='wlan0'):
+    """ IPv4 address of ifname or None if it has none (down, not associated yet, doesn't exist) """
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', ifname[:15].encode('utf-8')))
+            except OSError:
+                return None
+        return socket.inet_ntoa(ifreq[20:24])
+    return get_route_ip()
+
+def get_route_ip():
+    """ Source address the kernel would use for the default route. UDP connect sends no packets """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.connect(('10.255.255.255', 1))
+            ip = s.getsockname()[0]
+        except OSError:
+            return None
+    return None if ip.startswith('127.') or ip == '0.0.0.0' else ip
+
+def wait_for_network(ifname='wlan0', timeout=5.0, poll=0.1, until=None):
+    """ Poll until ifname has an address or until() returns True. Returns (connected, hostname, ip) like
+        check_connection(). Stopped by until() the ip is the default route's source address (any interface) """
+    deadline = perf_counter() + timeout
+    while True:
+        ip = get_ip(ifname)
+        if ip is not None and not ip.startswith('127.'):
+            return True, socket.gethostname(), ip
+        if until is not None and until():
+            return True, socket.gethostname(), get_route_ip() or 'unknown'
+        if perf_counter() >= deadline:
+            return False, socket.gethostname(), 'not connected'
+        sleep(poll)
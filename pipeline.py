@@ -0,0 +1,177 @@
+#====== PUBLISH PIPELINE ================#
+# mqtt_client.publish() never says no. Every call adds a packet to paho's outgoing queue and at high
+# rates (or QoS 1 with a slow broker) that queue grows until the Pi runs out of memory.
+# PublishPipeline caps the number of messages in flight (published but not yet acked in on_publish,
+# for QoS 0 that means not yet written to the socket). When the window is full the mode decides:
+#   'block'    = the producer waits for a free slot (block_timeout, then the message is dropped)
+#   'drop'     = the new message is dropped and counted
+#   'coalesce' = keep only the latest message per topic and send it when a slot frees up
+# Batcher collects readings per topic and publishes them as one message per interval.
+#     pipeline = PublishPipeline(supervisor, max_inflight=20, mode='coalesce')
+#     pipeline.publish(topic, payload)
+#     pipeline.acked(mid)          # in on_publish
+#     pipeline.reset()             # in on_disconnect
+
+import logging, threading
+from collections import OrderedDict
+from time import perf_counter
+
+BLOCK, DROP, COALESCE = 'block', 'drop', 'coalesce'
+MODES = (BLOCK, DROP, COALESCE)
+
+class PublishPipeline:
+    """ publisher is anything with publish(topic, payload, qos, retain) returning a paho MQTTMessageInfo
+        (or None when the message was spooled), ie ReconnectSupervisor or mqtt.Client """
+
+    def __init__(self, publisher, max_inflight=20, mode=BLOCK, block_timeout=None):
+        if mode not in MODES:
+            raise ValueError("mode must be one of {0} (got {1})".format(MODES, mode))
+        if max_inflight < 1:
+            raise ValueError("max_inflight must be >= 1 (got {0})".format(max_inflight))
+        self.publisher = publisher
+        self.max_inflight = max_inflight
+        self.mode = mode
+        self.block_timeout = block_timeout
+        self._lock = threading.Lock()
+        self._free = threading.Condition(self._lock)
+        self._inflight = set()        # mids published, not yet acked
+        self._reserved = 0            # Slots taken by publish() calls still inside publisher.publish
+        self._early = OrderedDict()   # mids acked before publish() returned them (oldest first)
+        self._pending = OrderedDict() # coalesce: topic -> (payload, qos, retain)
+        self.published = 0
+        self.dropped = 0
+        self.coalesced = 0            # Messages replaced by a newer one on the same topic
+        self.blocked_sec = 0.0
+        self.high_water = 0
+
+    def _used(self):
+        return len(self._inflight) + self._reserved
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """ Returns True if the message was published (or spooled), False if dropped or coalesced for later """
+        with self._lock:
+            if self._used() >= self.max_inflight:
+                if self.mode == DROP:
+                    self.dropped += 1
+                    return False
+                if self.mode == COALESCE:
+                    if self._pending.pop(topic, None) is not None:
+                        self.coalesced += 1
+                    self._pending[topic] = (payload, qos, retain)
+                    return False
+                t0 = perf_counter()
+                room = self._free.wait_for(lambda: self._used() < self.max_inflight, self.block_timeout)
+                self.blocked_sec += perf_counter() - t0
+                if not room:
+                    self.dropped += 1
+                    return False
+            self._reserved += 1
+        self._send(topic, payload, qos, retain)
+        return True
+
+    def _send(self, topic, payload, qos, retain):
+        """ Publish in a reserved slot. The lock is not held here since paho may call on_publish inline """
+        try:
+            info = self.publisher.publish(topic, payload, qos, retain)
+        except Exception:
+            with self._lock:
+                self._release()
+                self._free.notify()
+            raise
+        with self._lock:
+            self.published += 1
+            if info is not None and info.rc == 0:
+                if info.mid in self._early:
+                    del self._early[info.mid]
+                else:
+                    self._inflight.add(info.mid)
+            self._release()
+            used = self._used()
+            if used > self.high_water:
+                self.high_water = used
+            self._free.notify()
+
+    def _release(self):
+        """ Give back a reserved slot. Call with the lock held """
+        self._reserved -= 1
+        if not self._reserved:
+            self._early.clear()       # Every send has matched its early ack. The rest were for other publishes
+
+    def acked(self, mid):
+        """ Call from on_publish. Frees a slot and sends the oldest coalesced message if there is one """
+        with self._lock:
+            if mid in self._inflight:
+                self._inflight.discard(mid)
+            else:
+                # Early acks only exist while a send is inside publisher.publish. Other acks are for messages
+                # published around the pipeline (ie the spool drain). Bounded, the oldest is forgotten first
+                if self._reserved:
+                    self._early[mid] = None
+                    if len(self._early) > 4 * self.max_inflight:
+                        self._early.popitem(last=False)
+                return
+            item = None
+            if self._pending:
+                item = self._pending.popitem(last=False)
+                self._reserved += 1
+            else:
+                self._free.notify()
+        if item is not None:
+            topic, (payload, qos, retain) = item
+            self._send(topic, payload, qos, retain)
+
+    def reset(self):
+        """ Call from on_disconnect. Acks for messages in flight will never arrive so free the window.
+            Coalesced messages are handed to the publisher (which spools them while offline) """
+        with self._lock:
+            self._inflight.clear()
+            self._early.clear()
+            pending, self._pending = self._pending, OrderedDict()
+            self._free.notify_all()
+        for topic, (payload, qos, retain) in pending.items():
+            try:
+                self.publisher.publish(topic, payload, qos, retain)
+            except Exception as error:
+                logging.info("(pipeline) could not hand over {0}: {1}".format(topic, error))
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    def stats(self):
+        with self._lock:
+            return {'mode': self.mode, 'inflight': len(self._inflight), 'max_inflight': self.max_inflight,
+                    'high_water': self.high_water, 'published': self.published, 'dropped': self.dropped,
+                    'coalesced': self.coalesced, 'pending': len(self._pending), 'blocked_sec': round(self.blocked_sec, 3)}
+
+class Batcher:
+    """ Hold readings per topic and publish each topic's readings as one message on flush()
+        (schedule flush every batch interval). A topic holding max_batch readings is flushed right away """
+
+    def __init__(self, pipeline, max_batch=100):
+        self.pipeline = pipeline
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._batches = {}            # (topic, codec name) -> (codec, [data, ...])
+        self.batches = 0
+        self.readings = 0
+
+    def add(self, topic, data, payload_codec):
+        key = (topic, payload_codec.name)
+        with self._lock:
+            self.readings += 1
+            batch = self._batches.setdefault(key, (payload_codec, []))[1]
+            batch.append(dict(data))           # Copy. Callers reuse their data dictionary
+            full = self._batches.pop(key) if len(batch) >= self.max_batch else None
+        if full is not None:
+            self._publish(topic, *full)
+
+    def flush(self):
+        with self._lock:
+            batches, self._batches = self._batches, {}
+        for (topic, _), (payload_codec, items) in batches.items():
+            self._publish(topic, payload_codec, items)
+
+    def _publish(self, topic, payload_codec, items):
+        self.batches += 1
+        self.pipeline.publish(topic, payload_codec.encode_many(items))
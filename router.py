@@ -0,0 +1,143 @@
+#====== TOPIC ROUTER ====================#
+# Register a handler per topic filter (MQTT wildcards '+' and '#' allowed), subscribe them all in
+# on_connect and dispatch incoming messages to every matching handler.
+# Filters are stored in a trie keyed by topic level so matching cost depends on the number of levels
+# in the topic, not the number of subscriptions. Results are cached per exact topic since devices
+# usually see the same few topics over and over.
+#     router = TopicRouter()
+#     router.add('template/host/instructions', handle_instructions)
+#     router.add('template/+/cmd/#', handle_cmd, qos=1)
+#     router.subscribe(client)               # in on_connect
+#     router.dispatch(msg.topic, msg.payload) # from the inbound workers
+
+import logging, threading
+
+class _Node:
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}    # level -> _Node. '+' and '#' are stored as ordinary keys
+        self.handlers = []    # Handlers whose filter ends at this node
+
+def validate_filter(topic_filter):
+    """ Raise ValueError if topic_filter is not a valid MQTT subscription filter """
+    if not topic_filter:
+        raise ValueError("topic filter can not be empty")
+    levels = topic_filter.split('/')
+    for n, level in enumerate(levels):
+        if '#' in level and (level != '#' or n != len(levels) - 1):
+            raise ValueError("'#' must be the whole last level: {0}".format(topic_filter))
+        if '+' in level and level != '+':
+            raise ValueError("'+' must be a whole level: {0}".format(topic_filter))
+    return levels
+
+class TopicRouter:
+    """ Topic filter -> handler(topic, payload) routing with a level trie and an exact-topic cache """
+
+    def __init__(self, cache_size=1024):
+        self._root = _Node()
+        self._filters = {}        # filter -> qos, in registration order (used to subscribe)
+        self._cache = {}          # topic -> tuple of handlers
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self.unmatched = 0        # Messages that matched no handler
+
+    def add(self, topic_filter, handler, qos=0):
+        levels = validate_filter(topic_filter)
+        with self._lock:
+            node = self._root
+            for level in levels:
+                node = node.children.setdefault(level, _Node())
+            node.handlers.append(handler)
+            self._filters[topic_filter] = max(qos, self._filters.get(topic_filter, 0))
+            self._cache.clear()
+
+    def route(self, topic_filter, qos=0):
+        """ Decorator version of add()
+            @router.route('template/host/instructions')
+            def handle_instructions(topic, payload): ... """
+        def register(handler):
+            self.add(topic_filter, handler, qos)
+            return handler
+        return register
+
+    def remove(self, topic_filter, handler=None):
+        """ Remove one handler (or all handlers if None) for topic_filter. Returns True if the filter is now unused """
+        levels = validate_filter(topic_filter)
+        with self._lock:
+            path = [self._root]
+            for level in levels:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+            node = path[-1]
+            if handler is None:
+                node.handlers = []
+            elif handler in node.handlers:
+                node.handlers.remove(handler)
+            self._cache.clear()
+            if node.handlers:
+                return False
+            self._filters.pop(topic_filter, None)
+            # Prune empty branches
+            for level, parent in zip(reversed(levels), reversed(path[:-1])):
+                child = parent.children[level]
+                if child.handlers or child.children:
+                    break
+                del parent.children[level]
+            return True
+
+    def subscriptions(self):
+        """ [(filter, qos), ...] suitable for client.subscribe() """
+        with self._lock:
+            return list(self._filters.items())
+
+    def subscribe(self, client):
+        """ Subscribe every registered filter in one SUBSCRIBE packet. Call from on_connect """
+        subs = self.subscriptions()
+        if subs:
+            return client.subscribe(subs)
+
+    def match(self, topic):
+        """ Tuple of handlers whose filter matches topic """
+        handlers = self._cache.get(topic)
+        if handlers is not None:
+            return handlers
+        levels = topic.split('/')
+        found = []
+        with self._lock:
+            self._walk(self._root, levels, 0, found, topic.startswith('$'))
+            handlers = tuple(found)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[topic] = handlers
+        return handlers
+
+    def _walk(self, node, levels, n, found, system):
+        # Wildcards at the first level never match '$' topics ($SYS/...) per the MQTT spec
+        wild = not (system and n == 0)
+        if wild:
+            hash_node = node.children.get('#')
+            if hash_node is not None:
+                found.extend(hash_node.handlers)     # 'a/#' also matches 'a'
+        if n == len(levels):
+            found.extend(node.handlers)
+            return
+        child = node.children.get(levels[n])
+        if child is not None:
+            self._walk(child, levels, n + 1, found, system)
+        if wild:
+            plus = node.children.get('+')
+            if plus is not None:
+                self._walk(plus, levels, n + 1, found, system)
+
+    def dispatch(self, topic, payload):
+        """ Call every matching handler. Returns the number of handlers called """
+        handlers = self.match(topic)
+        if not handlers:
+            self.unmatched += 1
+            logging.debug("(router) no handler for topic %s", topic)   # %-args: formatted only if DEBUG is on
+        for handler in handlers:
+            handler(topic, payload)
+        return len(handlers)
@@ -0,0 +1,179 @@
+#====== PARALLEL SAMPLING ENGINE ========#
+# Sensor reads run in a worker pool so one slow or blocking driver (ie a DHT11 read retrying for
+# ~2 sec) can not delay the other sensors or the publisher. Per sensor the pool is 'thread'
+# (I/O bound drivers, default) or 'process' (CPU heavy or GIL holding drivers, uses the other cores).
+# Workers write results into a shared-memory ring buffer (SharedRing) that both pools can reach.
+# A dispatcher thread reads the ring and calls on_sample(idx, t, values) one sample at a time, so
+# the publish side only ever handles finished readings.
+# Each sensor has at most one read outstanding. A read running longer than its timeout marks the
+# sensor 'timeout' and new reads are skipped until it returns, so a hung driver can't pile up work.
+#     engine = SamplingEngine(on_sample=publish_sample, processes=2)
+#     engine.add_sensor(1, read_dht11, executor='process', timeout=3.0)
+#     scheduler.every(2.0, engine.sample, 1)     # never blocks
+
+import logging, multiprocessing, struct, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from time import perf_counter, time
+
+UNKNOWN, OK, SLOW, TIMEOUT, ERROR = 'unknown', 'ok', 'slow', 'timeout', 'error'
+
+class SharedRing:
+    """ Fixed-size ring of (sensor idx, timestamp, values...) records in shared memory.
+        Writers (threads or processes) take the shared lock. One reader keeps its own cursor """
+    _HEADER = struct.Struct('<Q')         # Records written so far
+
+    def __init__(self, capacity=1024, nvalues=2, name=None, lock=None):
+        self.capacity = capacity
+        self.nvalues = nvalues
+        self.record = struct.Struct('<Id' + 'd' * nvalues)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self._HEADER.size + capacity * self.record.size)
+            self._HEADER.pack_into(self.shm.buf, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        self._cursor = 0
+        self.lost = 0                     # Records overwritten before the reader got to them
+
+    def write(self, idx, t, values):
+        buf = self.shm.buf
+        with self.lock:
+            n = self._HEADER.unpack_from(buf, 0)[0]
+            self.record.pack_into(buf, self._HEADER.size + (n % self.capacity) * self.record.size, idx, t, *values)
+            self._HEADER.pack_into(buf, 0, n + 1)
+
+    def read_new(self):
+        """ Records written since the last call, oldest first """
+        buf = self.shm.buf
+        with self.lock:
+            n = self._HEADER.unpack_from(buf, 0)[0]
+            start = max(self._cursor, n - self.capacity)
+            records = [self.record.unpack_from(buf, self._HEADER.size + (k % self.capacity) * self.record.size)
+                       for k in range(start, n)]
+        self.lost += start - self._cursor
+        self._cursor = n
+        return records
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+#====== WORKER SIDE =====================#
+_worker_ring = None      # Ring attached in each process pool worker
+
+def _attach_ring(name, capacity, nvalues, lock):
+    global _worker_ring
+    _worker_ring = SharedRing(capacity, nvalues, name=name, lock=lock)
+
+def _read_into_ring(ring, reader, idx):
+    values = reader()
+    (ring or _worker_ring).write(idx, time(), values)
+
+class _Sensor:
+    __slots__ = ('idx', 'reader', 'executor', 'timeout', 'future', 'started', 'state',
+                 'reads', 'errors', 'timeouts', 'skipped', 'last_read_sec')
+
+    def __init__(self, idx, reader, executor, timeout):
+        self.idx, self.reader, self.executor, self.timeout = idx, reader, executor, timeout
+        self.future = None
+        self.started = 0.0
+        self.state = UNKNOWN
+        self.reads = self.errors = self.timeouts = self.skipped = 0
+        self.last_read_sec = None
+
+class SamplingEngine:
+
+    def __init__(self, on_sample, nvalues=2, capacity=1024, threads=4, processes=0):
+        self.on_sample = on_sample        # on_sample(idx, t, values). Called from the dispatcher thread only
+        self.ring = SharedRing(capacity, nvalues)
+        self._threads = ThreadPoolExecutor(threads, thread_name_prefix='sample')
+        self._processes = None
+        if processes:
+            self._processes = ProcessPoolExecutor(processes, initializer=_attach_ring,
+                                                  initargs=(self.ring.name, capacity, nvalues, self.ring.lock))
+        self._sensors = {}
+        self._wakeup = threading.Event()
+        self._running = True
+        self._dispatcher = threading.Thread(target=self._dispatch, name="sample-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def add_sensor(self, idx, reader, executor='thread', timeout=2.0):
+        """ reader() returns a tuple of nvalues numbers. Must be a module level function for executor='process' """
+        if executor not in ('thread', 'process'):
+            raise ValueError("executor must be 'thread' or 'process' (got {0})".format(executor))
+        if executor == 'process' and self._processes is None:
+            raise ValueError("sensor {0} wants a process worker but the engine has processes=0".format(idx))
+        self._sensors[idx] = _Sensor(idx, reader, executor, timeout)
+
+    def sample(self, idx):
+        """ Start a read of sensor idx. Returns False (without blocking) if the previous read is still running """
+        sensor = self._sensors[idx]
+        now = perf_counter()
+        if sensor.future is not None and not sensor.future.done():
+            if now - sensor.started > sensor.timeout and sensor.state != TIMEOUT:
+                sensor.state = TIMEOUT
+                sensor.timeouts += 1
+                logging.info("(sample) sensor {0} read still running after {1} sec".format(idx, sensor.timeout))
+            sensor.skipped += 1
+            return False
+        sensor.started = now
+        try:
+            if sensor.executor == 'process':
+                future = self._processes.submit(_read_into_ring, None, sensor.reader, idx)
+            else:
+                future = self._threads.submit(_read_into_ring, self.ring, sensor.reader, idx)
+        except (BrokenProcessPool, RuntimeError) as error:
+            sensor.state = ERROR
+            sensor.errors += 1
+            logging.info("(sample) sensor {0} could not be submitted: {1}".format(idx, error))
+            return False
+        sensor.future = future
+        future.add_done_callback(lambda f, sensor=sensor: self._done(sensor, f))
+        return True
+
+    def _done(self, sensor, future):
+        elapsed = perf_counter() - sensor.started
+        error = future.exception()
+        if error is not None:
+            sensor.state = ERROR
+            sensor.errors += 1
+            logging.info("(sample) sensor {0} read failed: {1}".format(sensor.idx, error))
+        else:
+            sensor.reads += 1
+            sensor.last_read_sec = elapsed
+            sensor.state = OK if elapsed <= sensor.timeout else SLOW
+        self._wakeup.set()
+
+    def _dispatch(self):
+        while self._running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            for idx, t, *values in self.ring.read_new():
+                try:
+                    self.on_sample(idx, t, values)
+                except Exception:
+                    logging.exception("(sample) on_sample failed for sensor {0}".format(idx))
+
+    def health(self):
+        """ {idx: state} where state is 'unknown', 'ok', 'slow', 'timeout' or 'error' """
+        return {idx: sensor.state for idx, sensor in self._sensors.items()}
+
+    def stats(self):
+        return {'lost': self.ring.lost,
+                'sensors': {idx: {'state': s.state, 'reads': s.reads, 'errors': s.errors, 'timeouts': s.timeouts,
+                                  'skipped': s.skipped, 'read_ms': round(s.last_read_sec * 1000, 2) if s.last_read_sec else None}
+                            for idx, s in self._sensors.items()}}
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+        self._dispatcher.join(1.0)
+        self.ring.close()
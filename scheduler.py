@@ -0,0 +1,129 @@
+#====== SAMPLING SCHEDULER ==============#
+# Deadline based scheduler for the main loop. Replaces the busy-wait
+#     while True:
+#         if (perf_counter() - t0_sec) > msginterval:
+# which pins a full core. Each job has its own interval and the scheduler sleeps until the
+# earliest deadline, so the main loop idles near 0% CPU between samples.
+# Fixed-rate: deadlines are start + n*interval (not 'last run + interval') so there is no drift.
+# If a job overruns by more than one interval the missed deadlines are skipped (counted in 'missed').
+
+import heapq, logging, threading
+from time import perf_counter
+
+class Job:
+    """ One scheduled callback. Keeps its own jitter stats (lateness of each run vs its deadline) """
+
+    def __init__(self, name, interval, func, args=()):
+        if interval <= 0:
+            raise ValueError("interval must be > 0 (got {0})".format(interval))
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.deadline = 0.0
+        self.count = 0        # Number of runs
+        self.missed = 0       # Deadlines skipped because the job (or another job) overran
+        self._mean = 0.0      # Running mean/variance of jitter (Welford) in seconds
+        self._m2 = 0.0
+        self.max_jitter = 0.0
+        self.cancelled = False
+
+    def record(self, jitter):
+        self.count += 1
+        delta = jitter - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (jitter - self._mean)
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+
+    def stats(self):
+        """ Jitter stats in milliseconds """
+        stdev = (self._m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+        return {'interval': self.interval, 'count': self.count, 'missed': self.missed,
+                'mean_ms': round(self._mean * 1000, 3), 'max_ms': round(self.max_jitter * 1000, 3),
+                'stdev_ms': round(stdev * 1000, 3)}
+
+class Scheduler:
+    """ Run callbacks at fixed rates. Sleeps (Event.wait) until the next deadline instead of polling.
+        sched = Scheduler()
+        sched.every(2.0, read_dht11)
+        sched.every(0.1, read_adc)
+        sched.run()   # blocks until sched.stop() (from a callback or another thread)
+    """
+
+    def __init__(self):
+        self._heap = []                  # (deadline, seq, job)
+        self._seq = 0                    # Tie breaker so jobs with equal deadlines never get compared
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event() # Set by stop() or every() so the sleeping loop re-checks
+        self._running = False
+
+    def every(self, interval, func, *args, name=None, start=None):
+        """ Schedule func(*args) every interval seconds. First run is at start (perf_counter) or one interval from now """
+        job = Job(name or getattr(func, '__name__', 'job'), interval, func, args)
+        job.deadline = (perf_counter() + interval) if start is None else start
+        with self._lock:
+            self._jobs[job.name] = job
+            self._push(job)
+        self._wakeup.set()
+        return job
+
+    def cancel(self, job):
+        job.cancelled = True
+        with self._lock:
+            self._jobs.pop(job.name, None)
+
+    def _push(self, job):
+        self._seq += 1
+        heapq.heappush(self._heap, (job.deadline, self._seq, job))
+
+    def run_pending(self, now=None):
+        """ Run every job whose deadline has passed. Returns seconds until the next deadline (None if no jobs) """
+        now = perf_counter() if now is None else now
+        while True:
+            with self._lock:
+                if not self._heap:
+                    return None
+                deadline, _, job = self._heap[0]
+                if job.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                if deadline > now:
+                    return deadline - now
+                heapq.heappop(self._heap)
+            job.record(now - deadline)
+            try:
+                job.func(*job.args)
+            except Exception:
+                logging.exception("(sched) job {0} raised".format(job.name))
+            now = perf_counter()
+            # Fixed rate. Advance by whole intervals, skipping any deadlines already in the past
+            job.deadline = deadline + job.interval
+            if job.deadline <= now:
+                skipped = int((now - job.deadline) // job.interval) + 1
+                job.missed += skipped
+                job.deadline += skipped * job.interval
+            with self._lock:
+                if not job.cancelled:
+                    self._push(job)
+
+    def run(self):
+        """ Main loop. Sleeps until the earliest deadline. Returns after stop() """
+        self._running = True
+        while self._running:
+            self._wakeup.clear()
+            delay = self.run_pending()
+            if not self._running:
+                break
+            self._wakeup.wait(delay)     # None (no jobs) sleeps until every()/stop()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def stats(self):
+        """ Jitter stats per job name """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {job.name: job.stats() for job in jobs}
@@ -0,0 +1,141 @@
+#====== OFFLINE SPOOL ===================#
+# Disk backed ring buffer for publishes made while the broker is unreachable.
+# The file is memory-mapped so appends are plain memory copies and the OS pages data out to disk,
+# keeping RAM flat no matter how long the outage is. The file has a fixed size (size cap). When it
+# is full the eviction policy drops either the oldest records ('drop-oldest') or the new one ('drop-newest').
+# The header (read/write offsets, counts) lives in the file so spooled data also survives a restart.
+#
+# File layout
+#   header : magic, data capacity, head (read offset), tail (write offset), record count, dropped count
+#   data   : records laid end to end, wrapping around at capacity
+#            record = length (uint32, whole record), qos (uint8), topic length (uint16), topic, payload
+
+import logging, mmap, os, struct, threading
+
+MAGIC = b'SPL1'
+_HEADER = struct.Struct('<4sIQQIQ')     # magic, capacity, head, tail, count, dropped
+_HEADER_SIZE = 64                       # Header padded so data starts on a tidy offset
+_RECORD = struct.Struct('<IBH')         # length, qos, topic length
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+class Spool:
+    """ Fixed size, memory-mapped FIFO of (topic, payload, qos)
+        spool = Spool('/home/pi/.template-spool', size=4*1024*1024)
+        spool.append('demo/sensor/data', payload)
+        topic, payload, qos = spool.peek()   # publish it, then
+        spool.pop()
+    """
+
+    def __init__(self, path, size=4 * 1024 * 1024, eviction=DROP_OLDEST):
+        if eviction not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("eviction must be '{0}' or '{1}' (got {2})".format(DROP_OLDEST, DROP_NEWEST, eviction))
+        if size <= _HEADER_SIZE + _RECORD.size:
+            raise ValueError("spool size {0} too small".format(size))
+        self.path = path
+        self.eviction = eviction
+        self.capacity = size - _HEADER_SIZE
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+        self._peeked = None
+        magic, capacity, head, tail, count, dropped = _HEADER.unpack_from(self._mm, 0)
+        if magic == MAGIC and capacity == self.capacity and 0 <= tail - head <= capacity:
+            self._head, self._tail, self.count, self.dropped = head, tail, count, dropped
+            if count:
+                logging.info("(spool) recovered {0} spooled messages from {1}".format(count, path))
+        else:
+            self._head = self._tail = self.count = self.dropped = 0
+            self._write_header()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mm, 0, MAGIC, self.capacity, self._head, self._tail, self.count, self.dropped)
+
+    def _write(self, offset, data):
+        """ Copy data into the ring at logical offset, wrapping at capacity """
+        pos = offset % self.capacity
+        first = min(len(data), self.capacity - pos)
+        self._mm[_HEADER_SIZE + pos:_HEADER_SIZE + pos + first] = data[:first]
+        if first < len(data):
+            self._mm[_HEADER_SIZE:_HEADER_SIZE + len(data) - first] = data[first:]
+
+    def _read(self, offset, n):
+        pos = offset % self.capacity
+        first = min(n, self.capacity - pos)
+        data = self._mm[_HEADER_SIZE + pos:_HEADER_SIZE + pos + first]
+        if first < n:
+            data += self._mm[_HEADER_SIZE:_HEADER_SIZE + n - first]
+        return data
+
+    def _record_length(self, offset):
+        return _RECORD.unpack(self._read(offset, _RECORD.size))[0]
+
+    @property
+    def used(self):
+        return self._tail - self._head
+
+    def __len__(self):
+        return self.count
+
+    def append(self, topic, payload, qos=0):
+        """ Spool one message. Returns False if this message was dropped """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        topic_b = topic.encode('utf-8')
+        record = _RECORD.pack(_RECORD.size + len(topic_b) + len(payload), qos, len(topic_b)) + topic_b + bytes(payload)
+        with self._lock:
+            if len(record) > self.capacity:
+                self.dropped += 1
+                self._write_header()
+                return False
+            while self.capacity - self.used < len(record):
+                if self.eviction == DROP_NEWEST:
+                    self.dropped += 1
+                    self._write_header()
+                    return False
+                self._head += self._record_length(self._head)   # Evict oldest
+                self.count -= 1
+                self.dropped += 1
+            self._write(self._tail, record)
+            self._tail += len(record)
+            self.count += 1
+            self._write_header()
+        return True
+
+    def peek(self):
+        """ Oldest (topic, payload, qos) without removing it. None if empty """
+        with self._lock:
+            if not self.count:
+                return None
+            raw = self._read(self._head, self._record_length(self._head))
+            self._peeked = self._head
+        length, qos, topic_len = _RECORD.unpack_from(raw)
+        start = _RECORD.size + topic_len
+        return raw[_RECORD.size:start].decode('utf-8'), raw[start:length], qos
+
+    def pop(self):
+        """ Remove the oldest message (after it was published). No-op if it was already evicted since peek() """
+        with self._lock:
+            if not self.count or self._peeked != self._head:
+                return
+            self._head += self._record_length(self._head)
+            self.count -= 1
+            self._peeked = None
+            if not self.count:
+                self._head = self._tail = 0      # Restart at the top of the file when empty
+            self._write_header()
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        with self._lock:
+            self._mm.flush()
+            self._mm.close()
+            os.close(self._fd)
+
+    def stats(self):
+        return {'count': self.count, 'used': self.used, 'capacity': self.capacity, 'dropped': self.dropped}
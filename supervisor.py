@@ -0,0 +1,136 @@
+#====== RECONNECT SUPERVISOR ============#
+# Replaces mqtt_client.loop_start(). Runs the paho network loop in its own thread and, when the
+# connection drops, reconnects with exponential backoff (plus jitter so a fleet of Pis does not
+# hammer the broker in step after it restarts).
+# While offline, publish() writes to the Spool (spool.py). Once reconnected the spool is drained
+# at drain_rate messages/sec so the backlog does not swamp the broker or starve live data.
+# Live publishes go through the spool while it still holds a backlog so message order is kept.
+# Every socket write happens on the supervisor thread. publish() from any other thread only queues
+# the packet in paho and wakes loop() (paho's socket pair), so concurrent publishers can not
+# interleave partial writes on a slow connection.
+#     supervisor = ReconnectSupervisor(mqtt_client, spool=Spool(path)).start()
+#     supervisor.publish(topic, payload)
+
+import logging, random, socket, threading
+from time import perf_counter
+import paho.mqtt.client as mqtt
+
+class ReconnectSupervisor:
+
+    def __init__(self, client, spool=None, min_delay=1.0, max_delay=120.0, drain_rate=50.0, loop_timeout=1.0, metrics=None):
+        self.client = client
+        self.spool = spool
+        self.metrics = metrics            # Optional metrics.Metrics. Every publish mid is reported to it
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.drain_rate = drain_rate      # Max spooled msgs/sec published after reconnecting
+        self.loop_timeout = loop_timeout
+        self.connections = 0              # Successful connections. reconnects = connections - 1
+        self.spooled = 0                  # publish() calls written to the spool
+        self._delay = min_delay
+        self._was_connected = False
+        self._tokens = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        # With a register_write callback set paho queues the packet instead of calling loop_write() on the
+        # publishing thread. loop() then writes it (the publish wakes its select() through the socket pair)
+        client.on_socket_register_write = self._on_socket_register_write
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="mqtt-supervisor", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.spool is not None:
+            self.spool.flush()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        pass                              # loop() selects for write while packets are queued
+
+    def connected(self):
+        return self.client.is_connected()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """ Publish now if connected, else spool. Returns the paho MQTTMessageInfo or None if spooled """
+        if self.spool is not None and (not self.connected() or len(self.spool)):
+            self._spool(topic, payload, qos)
+            return None
+        info = self.client.publish(topic, payload, qos, retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and self.spool is not None:
+            self._spool(topic, payload, qos)    # Lost the connection between the check and the publish
+            return None
+        if self.metrics is not None:
+            self.metrics.publish_sent(info.mid)
+        return info
+
+    def _spool(self, topic, payload, qos):
+        self.spooled += 1
+        if not self.spool.append(topic, payload, qos):
+            logging.debug("(spool) full, dropped message for %s", topic)
+
+    def _backoff(self):
+        """ Sleep the current delay (with +/-25% jitter) then double it up to max_delay """
+        delay = self._delay * random.uniform(0.75, 1.25)
+        logging.info("(mqtt) reconnecting in {0:.1f} sec".format(delay))
+        self._stop.wait(delay)
+        self._delay = min(self._delay * 2, self.max_delay)
+
+    def _run(self):
+        last = perf_counter()
+        while not self._stop.is_set():
+            if self.client.socket() is None:       # No socket. (Re)connect with backoff
+                try:
+                    self.client.reconnect()        # Uses host/port given to connect() or connect_async()
+                except (socket.error, OSError, ValueError) as error:
+                    logging.info("(mqtt) connect failed: {0}".format(error))
+                    self._backoff()
+                    continue
+            busy = self.spool is not None and len(self.spool) and self.connected()
+            rc = self.client.loop(timeout=0.05 if busy else self.loop_timeout)
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                if self._was_connected:
+                    logging.info("(mqtt) connection lost (rc {0})".format(rc))
+                self._was_connected = False
+                self._backoff()
+                continue
+            now = perf_counter()
+            if self.connected():
+                if not self._was_connected:
+                    self.connections += 1
+                    self._was_connected = True
+                    self._delay = self.min_delay
+                    self._tokens = 0.0
+                if busy:
+                    self._drain(now - last)
+            last = now
+
+    def _drain(self, elapsed):
+        """ Publish spooled messages. Token bucket limits to drain_rate msgs/sec """
+        self._tokens = min(self._tokens + elapsed * self.drain_rate, self.drain_rate)
+        while self._tokens >= 1.0:
+            item = self.spool.peek()
+            if item is None:
+                logging.info("(spool) drained")
+                return
+            topic, payload, qos = item
+            info = self.client.publish(topic, payload, qos)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                return                            # Disconnected again. Keep it spooled
+            if self.metrics is not None:
+                self.metrics.publish_sent(info.mid)
+            self.spool.pop()
+            self._tokens -= 1.0
+
+    @property
+    def reconnects(self):
+        return max(self.connections - 1, 0)
+
+    def stats(self):
+        stats = {'connected': self.connected(), 'reconnects': self.reconnects, 'spooled': self.spooled}
+        if self.spool is not None:
+            stats['spool'] = self.spool.stats()
+        return stats
@@ -8,23 +8,56 @@
 # sensorData (1, 2, ..)
 # demo --> RPi
 
-from time import sleep, perf_counter
+from time import sleep, perf_counter, time
+T_START = perf_counter()         # Startup time is measured from here to the first successful mqtt connection
 import logging, random
-from gpiozero import LED         # used to check initial setup
 import paho.mqtt.client as mqtt  # used for mqtt
 import sys, socket, os, json     # Used for mqtt
 from pathlib import Path         # Used for mqtt
-from subprocess import check_output # alternate method to see IP address
+import netcheck                  # In-process IP address check (no subprocesses, no fixed sleeps)
+from scheduler import Scheduler  # Sleeps until the next sample deadline instead of busy-waiting
+from inbound import InboundQueue # Bounded queue + worker threads for incoming messages
+from router import TopicRouter   # Topic filter (+/# wildcards) -> handler routing
+import codec                     # JSON or compact binary (struct) payloads
+from spool import Spool          # Disk backed (mmap) store for publishes made while offline
+from supervisor import ReconnectSupervisor  # Network loop thread with reconnect/backoff and spool draining
+from metrics import Metrics      # Publish/ack latency, rates, reconnects, jitter. Published on .../metrics
+from scheduler import Job
+from aggregate import SensorProcessor  # Per sensor sample window, deadband and window summaries
+from pipeline import PublishPipeline, Batcher  # Bounded in-flight window with backpressure, optional batching
+from history import SensorHistory      # Recent readings per sensor (fixed memory) for backfill queries
+import tracing                         # Logging through a background writer thread, sampled message traces
+from tracing import tracer
+
+def read_demo_sensor():
+    """ The hardware read. Replace with the real driver call. Runs in a sampling worker (thread or process) """
+    sensorData1 = float(random.randrange(1, 50, 1))
+    sensorData2 = int(random.randrange(1, 50, 1))
+    return sensorData1, sensorData2
 
 class DemoSensor:
 
-    def __init__(self, led_pin, pub_topic):
-        self.led = LED(led_pin)
+    def __init__(self, led_pin, pub_topic, interval=3.0, payload_codec='json', report='raw', window=60, deadband=0.0, max_silence=None,
+                 reader=read_demo_sensor, executor='thread', read_timeout=2.0, history_bytes=64 * 1024):
+        from gpiozero import LED     # Imported here (slow import) so it does not delay the mqtt connect at startup
+        self.led = LED(led_pin)      # used to check initial setup
         self.topic = pub_topic
+        self.interval = interval  # Seconds between samples. DHT11 min is 2sec
+        self.reader = reader      # Returns (sensorData1, sensorData2). Module level function if executor='process'
+        self.executor = executor  # Sampling worker: 'thread' (I/O bound driver) or 'process' (CPU bound / holds the GIL)
+        self.read_timeout = read_timeout  # Reads running longer mark the sensor unhealthy ('timeout')
+        self.codec = codec.get_codec(payload_codec)  # 'json' or a registered binary schema, ie 'demo-sensor'
+        # report='raw' publishes every sample. 'deadband' only when a value moved more than deadband (or max_silence sec passed).
+        # 'summary' publishes min/max/mean/std every 'window' samples on pub_topic + '/summary'
+        self.processor = SensorProcessor(('sensorData1f', 'sensorData2i'), mode=report, window=window,
+                                         deadband=deadband, max_silence=max_silence)
+        # Every sample (published or not) is kept in a fixed size ring, answered by 'history' instructions
+        self.history = SensorHistory((('sensorData1f', 'f'), ('sensorData2i', 'i')), budget=history_bytes)
 
 
 #====== IP ADDRESS CHECK ==============#
 # Getting IP address. IP address will change over time and if Pi is offline vs online. 
+# Slow path (FAST_START = False). Fast path is netcheck.wait_for_network()
 
 def get_ipGP():
     
@@ -36,6 +69,7 @@ def get_ipGP():
     return ip
 
 def check_connection():
+    from subprocess import check_output # alternate method to see IP address
     sleep(3) # allow time for device to connect
     logging.info(check_output(['hostname', '-I'])) # Alternate way to display IP for confirmation
     hostname = socket.gethostname()
@@ -46,19 +80,23 @@ def check_connection():
 
 #====== MQTT CALLBACK FUNCTIONS ==========#
 # Each callback function needs to be 1) defined and 2) assigned/linked in main program below
-# on_connect = Connect to the broker and subscribe to TOPICs
-# on_disconnect = Stop the loop and log the reason code
-# on_message = When a message is received get the contents and assign it to a python dictionary (must be subscribed to the TOPIC)
-# on_publish = Send a message to the broker
+# on_connect = Connect to the broker and subscribe to every TOPIC registered with the router
+# on_disconnect = Log the reason code. The supervisor reconnects with backoff and publishes are spooled meanwhile
+# on_message = When a message is received put the raw topic/payload on the inbound queue (must be subscribed to the TOPIC)
+#              A worker thread routes it to the handler(s) registered for the topic. Keeps the paho network thread free.
+# on_publish = Send a message to the broker. Frees a slot in the publish pipeline's in-flight window
 
 def on_connect(client, userdata, flags, rc):
     """ on connect callback verifies a connection established and subscribe to TOPICs"""
     logging.info("(mqtt) attempting on_connect")
     if rc==0:
         mqtt_client.connected = True          # If rc = 0 then successful connection
-        client.subscribe(MQTT_SUB_TOPIC)     # Subscribe to topic
+        if mqtt_client.startup_sec is None:
+            mqtt_client.startup_sec = perf_counter() - T_START
+            logging.info("(startup) Connected {0:.3f} sec after start".format(mqtt_client.startup_sec))
+        router.subscribe(client)             # Subscribe to all routed topics
         logging.info("(mqtt) Successful Connection: {0}".format(str(rc)))
-        logging.info("(mqtt) Subscribed to: {0}\n".format(MQTT_SUB_TOPIC))
+        logging.info("(mqtt) Subscribed to: {0}\n".format(router.subscriptions()))
     else:
         mqtt_client.failed_connection = True  # If rc != 0 then failed to connect. Set flag to stop mqtt loop
         logging.info("(mqtt) Unsuccessful Connection - Code {0}".format(str(rc)))
@@ -72,26 +110,101 @@ def on_connect(client, userdata, flags, rc):
         5: Connection refused: Not authorized '''
 
 def on_message(client, userdata, msg):
-    """on message callback will receive messages from the server/broker. Must be subscribed to the topic in on_connect"""
-    global mqtt_newmsg, incomingD
-    if msg.topic == MQTT_SUB_TOPIC:
-        incomingD = json.loads(str(msg.payload.decode("utf-8", "ignore")))  # decode the json msg and convert to python dictionary
-        mqtt_newmsg = True
-        # Debugging. Will print the JSON incoming payload and unpack the converted dictionary
-        logging.debug("(mqtt) Receive: msg on subscribed topic: {0} with payload: {1}".format(msg.topic, str(msg.payload))) 
-        logging.debug("(mqtt) on_message converted (JSON->Dictionary) and unpacking")
-        for key, value in incomingD.items():
-            logging.debug("(mqtt) on_message Dict key:{0} value:{1}\n".format(key, value))
+    """on message callback will receive messages from the server/broker. Must be subscribed to the topic in on_connect
+       Runs on the paho network thread so only enqueue the raw message. Workers call router.dispatch"""
+    metrics.message_received()
+    inbound.put(msg.topic, msg.payload)
+
+def on_message_async(client, userdata, msg):
+    """on message callback for RUNTIME = 'asyncio'. Already on the event loop thread so route directly (no queue, no locks)
+       Handler errors are logged here. Raised inside paho's loop_read they would leave the client unable to read"""
+    metrics.message_received()
+    try:
+        router.dispatch(msg.topic, msg.payload)
+    except Exception:
+        logging.exception("(mqtt) handler failed for {0}".format(msg.topic))
+
+def handle_instructions(topic, payload):
+    """ Handler for MQTT_SUB_TOPIC. Runs on an inbound worker thread for every message (none are overwritten by the next one) """
+    t0 = perf_counter()
+    incomingD = codec.decode(payload)  # decode the json (or binary schema) msg and convert to python dictionary
+    metrics.message_decoded(perf_counter() - t0)
+    # Debugging. Sampled trace of the incoming payload and the converted dictionary. Costs nothing while tracing is off
+    if tracer.enabled and tracer.sample():
+        tracer.trace("(mqtt) Receive: msg on subscribed topic: %s with payload: %s converted: %s", topic, payload, incomingD)
+    command = COMMANDS.get(incomingD.get('cmd')) if isinstance(incomingD, dict) else None   # ie {"cmd": "history", ...}
+    if command is not None:
+        command(incomingD)
+
+reply_tasks = set()    # RUNTIME 'asyncio': replies being published. Referenced so a task isn't garbage collected early
+
+def reply_done(task):
+    reply_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:     # ie ConnectionError while disconnected (no spool)
+        logging.info("(mqtt) reply not sent: {0}".format(task.exception()))
+
+def send_reply(topic, payload):
+    """ Reply to an instruction. Works from an inbound worker (thread runtime) or the event loop (asyncio runtime) """
+    if pipeline is not None:
+        pipeline.publish(topic, payload)
+    else:
+        import asyncio
+        task = asyncio.get_running_loop().create_task(aclient.publish(topic, payload))
+        reply_tasks.add(task)
+        task.add_done_callback(reply_done)
+
+def answer_history(request):
+    """ {"cmd": "history", "sensor": 1, "from": epoch sec, "to": epoch sec, "step": sec, "limit": n, "id": ..}
+        Every key but cmd and sensor is optional. Without step every reading in the range is returned, with step
+        one [mean, min, max] per bucket. Replies on MQTT_PUB_HISTORY_TOPIC (or the request's "reply_to") with the
+        request id and, when there are more than limit rows, "next" (and maybe "skip") = the "from" (and "skip")
+        of the follow up request """
+    reply = {'id': request.get('id'), 'sensor': request.get('sensor')}
+    try:
+        sensor = request.get('sensor')
+        demoSensor = demoHostMachine.get(sensor) if isinstance(sensor, (int, str)) else None   # Not a list etc (unhashable)
+        if demoSensor is None:
+            raise ValueError("unknown sensor {0}".format(request.get('sensor')))
+        limit = request.get('limit', HISTORY_MAX_ROWS)
+        if not isinstance(limit, int) or limit < 1:
+            raise ValueError("limit must be an integer >= 1 (got {0})".format(limit))
+        skip = request.get('skip', 0)
+        if not isinstance(skip, int) or skip < 0:
+            raise ValueError("skip must be an integer >= 0 (got {0})".format(skip))
+        reply.update(demoSensor.history.query(request.get('from'), request.get('to'), request.get('step'),
+                                              min(limit, HISTORY_MAX_ROWS), skip))
+    except (TypeError, ValueError) as error:
+        reply['error'] = str(error)
+    send_reply(request.get('reply_to') or MQTT_PUB_HISTORY_TOPIC, json.dumps(reply, separators=(',', ':')))
+
+def set_logging(request):
+    """ {"cmd": "log", "level": "DEBUG", "trace": true, "every": 10, "per_sec": 5}. Every key but cmd is optional
+        level = root log level. trace = message traces on/off, 1 in 'every' messages and at most 'per_sec' a second.
+        Replies with the current settings on the request's "reply_to" (if given) """
+    try:
+        settings = tracing.configure(request.get('level'), request.get('trace'), request.get('every'), request.get('per_sec'))
+    except (TypeError, ValueError) as error:
+        settings = {'error': str(error)}
+    logging.info("(log) settings: {0}".format(settings))
+    if request.get('reply_to'):
+        send_reply(request['reply_to'], json.dumps(dict(settings, id=request.get('id')), separators=(',', ':')))
+
+COMMANDS = {'history': answer_history, 'log': set_logging}   # 'cmd' value -> function(incomingD)
 
 def on_publish(client, userdata, mid):
-    """on publish will send data to broker"""
+    """on publish will send data to broker. mid matches the mid returned by publish, used for ack latency"""
     #logging.debug("(mqtt) msg ID: " + str(mid))
     #logging.debug("(mqtt) Published msg {0} with payload:{1}".format(MQTT_PUB_TOPIC, json.dumps(outgoingD)))
-    pass 
+    metrics.publish_acked(mid)
+    if pipeline is not None:
+        pipeline.acked(mid)
 
 def on_disconnect(client, userdata,rc=0):
     logging.debug("(mqtt) DisConnected result code "+str(rc))
-    mqtt_client.loop_stop()
+    mqtt_client.connected = False          # Supervisor thread handles reconnecting. Do not stop the loop
+    metrics.clear_inflight()               # Acks for messages in flight will not arrive
+    if pipeline is not None:
+        pipeline.reset()                   # Free the in-flight window. Coalesced messages go to the spool
 
 def get_login_info(file):
     home = str(Path.home())                    # Import mqtt and wifi info. Remove if hard coding in python script
@@ -99,37 +212,162 @@ def get_login_info(file):
         user_info = f.read().splitlines()
     return user_info
 
+def read_sensor(idx, demoSensor):
+    """ Read the demoSensor on this thread. Returns the data dictionary """
+    sensorData1, sensorData2 = demoSensor.reader()
+    outgoingD['data']['demoSensori'] = idx
+    outgoingD['data']['sensorData1f'] = sensorData1
+    outgoingD['data']['sensorData2i'] = sensorData2
+    return outgoingD['data']
+
+def process_sample(idx, demoSensor, data, t=None):
+    """ Keep the sample in the demoSensor history (t = epoch sec it was read) and run it through the processor.
+        Returns (topic, data, payload codec) to publish or None """
+    demoSensor.history.append(time() if t is None else t, data)
+    result = demoSensor.processor.add(data)
+    if result is None:
+        return None                                                    # Inside the deadband or window not full yet
+    kind, data = result
+    if kind == 'summary':
+        data['demoSensori'] = idx
+        return demoSensor.topic + '/summary', data, codec.JSON
+    return demoSensor.topic, data, demoSensor.codec
+
+def send(topic, data, payload_codec):
+    """ Publish through the pipeline (backpressure when the in-flight window is full, spooled if offline)
+        or hold the reading for the next batch """
+    if batcher is not None:
+        batcher.add(topic, data, payload_codec)
+    else:
+        pipeline.publish(topic, payload_codec.encode(data))
+
+def sample_and_publish(idx, demoSensor):
+    """ Scheduled job for one demoSensor. Read the sensor and publish the data (or summary) """
+    try:
+        message = process_sample(idx, demoSensor, read_sensor(idx, demoSensor))
+        if message is not None:
+            send(*message)  # publish data
+            if tracer.enabled and tracer.sample():
+                tracer.trace("(mqtt) Demo sensor %s", outgoingD)
+    except RuntimeError as error:
+        logging.info(error.args[0])
+
+def publish_sample(idx, t, values):
+    """ SamplingEngine on_sample callback (dispatcher thread). values were read by a sampling worker """
+    data = {'demoSensori': idx, 'sensorData1f': values[0], 'sensorData2i': int(values[1])}
+    message = process_sample(idx, demoHostMachine[idx], data, t)
+    if message is not None:
+        send(*message)  # publish data
+        if tracer.enabled and tracer.sample():
+            tracer.trace("(mqtt) Demo sensor %s", data)
+
+async def sample_and_publish_async(idx, demoSensor):
+    """ RUNTIME = 'asyncio' version. Each demoSensor runs this in its own task.
+        The read runs in the default thread pool so a blocking driver does not stall the event loop """
+    import asyncio
+    read = asyncio.get_running_loop().run_in_executor(None, demoSensor.reader)
+    try:
+        sensorData1, sensorData2 = await asyncio.wait_for(read, demoSensor.read_timeout)
+    except asyncio.TimeoutError:
+        logging.info("(sample) sensor {0} read took longer than {1} sec".format(idx, demoSensor.read_timeout))
+        return
+    data = {'demoSensori': idx, 'sensorData1f': sensorData1, 'sensorData2i': sensorData2}
+    message = process_sample(idx, demoSensor, data)
+    if message is not None:
+        topic, data, payload_codec = message
+        await aclient.publish(topic, payload_codec.encode(data))  # publish data (spooled if offline). Awaiting the ack is the backpressure
+        if tracer.enabled and tracer.sample():
+            tracer.trace("(mqtt) Demo sensor %s", data)
+
+def publish_metrics():
+    """ Scheduled job. Publish a compact metrics snapshot """
+    pipeline.publish(MQTT_PUB_METRICS_TOPIC, json.dumps(metrics.snapshot(), separators=(',', ':')))
+
+async def publish_metrics_async():
+    await aclient.publish(MQTT_PUB_METRICS_TOPIC, json.dumps(metrics.snapshot(), separators=(',', ':')))
+
+def setup_hardware():
+    """ Hardware setup. Each demoSensor has its own sample interval (seconds)
+        payload_codec='demo-sensor' sends 12 byte binary payloads instead of ~60 byte JSON (see codec.py)
+        For slow moving signals sample fast and publish less, ie interval=0.1, report='summary', window=600
+        (one summary a minute) or report='deadband', deadband=0.5, max_silence=60 """
+    demoHostMachine = {
+        1: DemoSensor(led_pin=26, pub_topic='demo/sensor/data', interval=3.0),
+        2: DemoSensor(led_pin=27, pub_topic='demo/sensor/data', interval=3.0)
+    }
+    demoHostMachine[1].led.on()
+    return demoHostMachine
+
+async def run_asyncio(server, port, spool, metrics_interval, min_delay, max_delay, drain_rate):
+    """ RUNTIME = 'asyncio'. One task per demoSensor plus one for metrics. Every mqtt callback runs on this event loop """
+    global aclient, demoHostMachine
+    import asyncio
+    import aioruntime                  # paho socket driven by the asyncio event loop
+    aclient = aioruntime.AsyncClient(mqtt_client, spool=spool, min_delay=min_delay, max_delay=max_delay,
+                                     drain_rate=drain_rate, metrics=metrics)
+    delay = min_delay
+    while True:
+        try:
+            await aclient.connect(server, port)    # Returns after CONNACK. on_connect subscribes the router topics
+            break
+        except (socket.error, OSError) as error:  # ConnectionError (refused by broker) is an OSError too
+            if mqtt_client.failed_connection:      # Bad user/password etc. Use the rc code to trouble shoot
+                raise
+            logging.info("(mqtt) connect failed: {0}. Retrying in {1} sec".format(error, delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    demoHostMachine = setup_hardware()
+    jobs = []
+    tasks = []
+    for idx, demoSensor in demoHostMachine.items():
+        job = Job("demoSensor{0}".format(idx), demoSensor.interval, sample_and_publish_async, (idx, demoSensor))
+        jobs.append(job)
+        tasks.append(asyncio.create_task(aioruntime.every(demoSensor.interval, sample_and_publish_async, idx, demoSensor, job=job)))
+    tasks.append(asyncio.create_task(aioruntime.every(metrics_interval, publish_metrics_async)))
+
+    metrics.add_source('reconnects', lambda: max(aclient.connections - 1, 0))
+    metrics.add_source('spool', lambda: len(spool))
+    metrics.add_source('jitter_ms', lambda: {job.name: [s['mean_ms'], s['max_ms'], s['missed']]
+                                             for job, s in ((job, job.stats()) for job in jobs)})
+    metrics.add_source('startup_sec', lambda: mqtt_client.startup_sec)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        logging.info("(aio) jitter stats: {0}".format({job.name: job.stats() for job in jobs}))
+        await aclient.disconnect()
+
 def main():
     ''' define global variables '''
-    global mqtt_client, outgoingD, incomingD, mqtt_newmsg
-    global MQTT_SUB_TOPIC, MQTT_PUB_RPI_TOPIC           # Can add more topics for subscribing/publishing
+    global mqtt_client, outgoingD, inbound, router, supervisor, metrics, aclient, demoHostMachine, pipeline, batcher
+    global MQTT_SUB_TOPIC, MQTT_PUB_RPI_TOPIC, MQTT_PUB_METRICS_TOPIC, MQTT_PUB_HISTORY_TOPIC  # Can add more topics for subscribing/publishing
+    global HISTORY_MAX_ROWS
     global led 
 
     #==== LOGGING/DEBUGGING ============#
     # Logging package allows you to easiliy turn print-like statements on/off GLOBALLY with 'level' settings below
-    # Using basicConfig logging at root level. The 'level', on/off, controls other modules with logging enabled.
-    
-    logging.basicConfig(level=logging.DEBUG)  # Set to DEBUG to get variables and status messages. 
-                                              # Set to INFO for status messages only.
-                                              # Set to CRITICAL to turn off
+    # Logging at root level. The 'level', on/off, controls other modules with logging enabled.
+    # Records are written by a background thread so logging never waits on the console/file.
+    # Per message output (payloads, samples) is a sampled trace instead, see tracing.py
+    # Both can be changed at runtime: {"cmd": "log", "level": "DEBUG", "trace": true} on MQTT_SUB_TOPIC
+    LOG_LEVEL = logging.INFO         # Set to DEBUG to get variables and status messages.
+                                     # Set to INFO for status messages only.
+                                     # Set to CRITICAL to turn off
+    TRACE = False                    # True = trace messages in/out ..
+    TRACE_EVERY = 100                # .. 1 in this many ..
+    TRACE_PER_SEC = 5                # .. and at most this many a second
+    log_listener = tracing.setup_logging(LOG_LEVEL)
+    tracing.configure(trace=TRACE, every=TRACE_EVERY, per_sec=TRACE_PER_SEC)
 
     #====   SETUP MQTT =================#
-    # Check for wifi connection. Using hostname for MQTT_SERVER so IP address is not necessary but IP add can still be useful.
-
-    connected, hostname, ip_address= check_connection()
-    if connected:
-        logging.info("Host appears connected to internet in first attempt. Continuing with MQTT setup.")
-    else:
-        logging.info("Host does not appear connected to internet on first check")
-        logging.info("Waiting and then checking internet connection 2nd time")
-        sleep(3)
-        connected, hostname, ip_address= check_connection()
-        if connected:
-            logging.info("2nd internet check successful. Continuing with MQTT setup.")
-        else:
-            logging.info("2nd internet check failed. Host either offline or problems connecting. Continuing with MQTT setup.")
-    logging.info("Host IP  : {0}".format(ip_address))
-    logging.info("Host name: {0}".format(hostname))
+    # RUNTIME 'thread' runs paho in the supervisor thread with inbound worker threads and the Scheduler.
+    # RUNTIME 'asyncio' drives the paho socket from an asyncio event loop, one task per demoSensor (see aioruntime.py).
+    RUNTIME = 'thread'                           # 'thread' or 'asyncio'
+    # FAST_START connects asynchronously first so the broker connect overlaps the network check.
+    # The network check reads the interface address in-process and polls instead of fixed sleeps.
+    FAST_START = True                            # False = original check_connection() with fixed sleeps
+    NETWORK_INTERFACE = 'wlan0'                  # Interface checked for an IP address
+    NETWORK_TIMEOUT = 5.0                        # FAST_START: max seconds to wait for an IP address
 
     user_info = get_login_info("stem")
     MQTT_SERVER = 'rpi3mqtt1.local'            # Replace with IP address of device running mqtt server/broker
@@ -138,14 +376,45 @@ def main():
     MQTT_SUB_TOPIC = 'template/host/instructions'   # Subscribe topic (incoming messages, instructions)
     # Note -  Temp data is published on a topic for each demoSensor defined in Hardware Setup
     MQTT_PUB_RPI_TOPIC = 'template/host/info'     # Publish topic (outgoing messages, data, instructions)
+    MQTT_PUB_METRICS_TOPIC = MQTT_PUB_RPI_TOPIC + '/metrics'  # Runtime metrics snapshots
+    MQTT_PUB_HISTORY_TOPIC = MQTT_PUB_RPI_TOPIC + '/history'  # Replies to {"cmd": "history"} instructions
+    HISTORY_MAX_ROWS = 1000                      # Max readings (or buckets) per history reply. Page with "next"
+    METRICS_INTERVAL = 30.0                      # Seconds between metrics snapshots
     MQTT_CLIENT_ID = 'pi3B'                      # Give your device a name
     WIFI_SSID = user_info[2]                     # Replace with your wifi SSID
     WIFI_PASSWORD = user_info[3]                 # Replace with your wifi password
+    INBOUND_MAXSIZE = 256                        # Max queued incoming messages before the overflow policy kicks in
+    INBOUND_POLICY = 'drop-oldest'               # 'drop-oldest', 'drop-newest' or 'block' (blocks paho network thread)
+    INBOUND_WORKERS = 2                          # Worker threads running the routed handlers
+    SPOOL_FILE = os.path.join(str(Path.home()), '.template-spool')  # Publishes made while offline are kept here
+    SPOOL_SIZE = 4 * 1024 * 1024                 # Spool size cap in bytes (fixed size file)
+    SPOOL_EVICTION = 'drop-oldest'               # When full: 'drop-oldest' or 'drop-newest'
+    SPOOL_DRAIN_RATE = 50                        # Max spooled msgs/sec published after reconnecting
+    RECONNECT_MIN_DELAY = 0.25 if FAST_START else 1.0  # Reconnect backoff doubles from this many sec ..
+    RECONNECT_MAX_DELAY = 120                    # .. up to this many sec
+    PARALLEL_SAMPLING = True                     # Read sensors in a worker pool (False = read inline in the scheduler)
+    SAMPLING_THREADS = 4                         # Thread workers for executor='thread' sensors
+    SAMPLING_PROCESSES = 2                       # Process workers, only started if a sensor uses executor='process'
+    PUBLISH_MAX_INFLIGHT = 20                    # Max publishes not yet acked (qos 0: not yet written to the socket)
+    PUBLISH_BACKPRESSURE = 'block'               # Window full: 'block' the sampler, 'drop' the new msg or 'coalesce' (latest per topic)
+    PUBLISH_BLOCK_TIMEOUT = 1.0                  # 'block': max seconds to wait for a slot, then the msg is dropped
+    PUBLISH_BATCH_INTERVAL = 0                   # Seconds. > 0 = send each topic's readings as one message per interval
+
+    #==== METRICS ======================#
+    # Created first since the mqtt callbacks update it
+    metrics = Metrics()
+
+    #==== TOPIC ROUTING ================#
+    # One handler per topic filter. Wildcards allowed, ie router.add('template/+/cmd/#', handle_cmd, qos=1)
+    # All filters are subscribed in on_connect (and again on every reconnect)
+    router = TopicRouter()
+    router.add(MQTT_SUB_TOPIC, handle_instructions)
 
     #==== START/BIND MQTT FUNCTIONS ====#
     # Create a couple flags in the mqtt.Client class to handle a failed attempt at connecting. If user/password is wrong we want to stop the loop.
     mqtt.Client.connected = False          # Flag for initial connection
     mqtt.Client.failed_connection = False  # Flag for failed initial connection
+    mqtt.Client.startup_sec = None         # Seconds from start to first connection
     # Create our mqtt_client object and bind/link to our callback functions
     mqtt_client = mqtt.Client(MQTT_CLIENT_ID)             # Create mqtt_client object
     mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD) # Need user/password to connect to broker
@@ -153,55 +422,142 @@ def main():
     mqtt_client.on_disconnect = on_disconnect             # Bind on disconnect
     mqtt_client.on_message = on_message                   # Bind on message
     mqtt_client.on_publish = on_publish                   # Bind on publish
+    mqtt_client.max_inflight_messages_set(PUBLISH_MAX_INFLIGHT)  # paho's own qos 1/2 window matches the pipeline
+    spool = Spool(SPOOL_FILE, size=SPOOL_SIZE, eviction=SPOOL_EVICTION)  # Publishes made while offline
+    outgoingD = {}
+    outgoingD['data'] = {}
+    demoHostMachine = {}                                  # Filled by setup_hardware() once connected
     logging.info("Connecting to: {0}".format(MQTT_SERVER))
-    mqtt_client.connect(MQTT_SERVER, 1883) # Connect to mqtt broker. This is a blocking function. Script will stop while connecting.
-    mqtt_client.loop_start()               # Start monitoring loop as asynchronous. Starts a new thread and will process incoming/outgoing messages.
-    # Monitor if we're in process of connecting or if the connection failed
+
+    pipeline = batcher = None
+    if RUNTIME == 'asyncio':
+        import asyncio                                    # Imported here (slow import) so RUNTIME 'thread' never loads it
+        mqtt_client.on_message = on_message_async         # Route on the event loop. No inbound queue needed
+        try:
+            asyncio.run(run_asyncio(MQTT_SERVER, 1883, spool, METRICS_INTERVAL, RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY, SPOOL_DRAIN_RATE))
+        except KeyboardInterrupt:
+            logging.info("Pressed ctrl-C")
+        except ConnectionError as error:
+            logging.info(error)
+        finally:
+            spool.close()
+            logging.info("GPIO cleaned up automatically with gpiozero")
+            log_listener.stop()                # Writes out the queued log records
+        return
+
+    if FAST_START:
+        mqtt_client.connect_async(MQTT_SERVER, 1883)      # Non blocking. Supervisor thread does the connect
+    else:
+        try:
+            mqtt_client.connect(MQTT_SERVER, 1883) # Connect to mqtt broker. This is a blocking function. Script will stop while connecting.
+        except (socket.error, OSError) as error:
+            logging.info("(mqtt) First connect failed ({0}). Supervisor will keep retrying".format(error))
+
+    #==== INBOUND QUEUE ================#
+    # Start before the supervisor so messages arriving right after subscribe are not lost
+    inbound = InboundQueue(router.dispatch, maxsize=INBOUND_MAXSIZE, policy=INBOUND_POLICY, workers=INBOUND_WORKERS).start()
+
+    # Supervisor replaces loop_start(). Starts a new thread that processes incoming/outgoing messages, reconnects with
+    # exponential backoff if the connection drops and spools publishes to disk while offline.
+    supervisor = ReconnectSupervisor(mqtt_client, spool=spool, min_delay=RECONNECT_MIN_DELAY,
+                                     max_delay=RECONNECT_MAX_DELAY, drain_rate=SPOOL_DRAIN_RATE, metrics=metrics)
+    # Every publish goes through the pipeline so a slow broker can't grow paho's outgoing queue without limit
+    pipeline = PublishPipeline(supervisor, max_inflight=PUBLISH_MAX_INFLIGHT, mode=PUBLISH_BACKPRESSURE,
+                               block_timeout=PUBLISH_BLOCK_TIMEOUT)
+    if PUBLISH_BATCH_INTERVAL:
+        batcher = Batcher(pipeline)
+    supervisor.start()
+
+    # Check for wifi connection while the supervisor connects. Using hostname for MQTT_SERVER so IP address is not necessary but IP add can still be useful.
+    if FAST_START:
+        # Stops as soon as the broker connected, so another interface name (ie eth0) doesn't cost NETWORK_TIMEOUT
+        connected, hostname, ip_address = netcheck.wait_for_network(NETWORK_INTERFACE, timeout=NETWORK_TIMEOUT,
+                                                                    until=lambda: mqtt_client.connected)
+        if connected:
+            logging.info("Host appears connected to internet. Continuing with MQTT setup.")
+        else:
+            logging.info("No IP address after {0} sec. Host either offline or problems connecting. Continuing with MQTT setup.".format(NETWORK_TIMEOUT))
+    else:
+        connected, hostname, ip_address= check_connection()
+        if connected:
+            logging.info("Host appears connected to internet in first attempt. Continuing with MQTT setup.")
+        else:
+            logging.info("Host does not appear connected to internet on first check")
+            logging.info("Waiting and then checking internet connection 2nd time")
+            sleep(3)
+            connected, hostname, ip_address= check_connection()
+            if connected:
+                logging.info("2nd internet check successful. Continuing with MQTT setup.")
+            else:
+                logging.info("2nd internet check failed. Host either offline or problems connecting. Continuing with MQTT setup.")
+    logging.info("Host IP  : {0}".format(ip_address))
+    logging.info("Host name: {0}".format(hostname))
+
+    # Monitor if we're in process of connecting or if the connection failed. Short poll so setup continues as soon as connected
+    logging.info("Waiting")
     while not mqtt_client.connected and not mqtt_client.failed_connection:
-        logging.info("Waiting")
-        sleep(1)
+        sleep(0.05)
     if mqtt_client.failed_connection:      # If connection failed then stop the loop and main program. Use the rc code to trouble shoot
-        mqtt_client.loop_stop()
+        supervisor.stop()
+        log_listener.stop()
         sys.exit()
 
     #==== MAIN LOOP ====================#
     # MQTT setup is successful. Initialize dictionaries and start the main loop.
 
-    # Hardware setup
-    demoHostMachine = {
-        1: DemoSensor(led_pin=26, pub_topic='demo/sensor/data'),
-        2: DemoSensor(led_pin=27, pub_topic='demo/sensor/data')
-    }
-
-    demoHostMachine[1].led.on()
-    outgoingD, incomingD = {}, {}
-    outgoingD['data'] = {}
+    demoHostMachine = setup_hardware()
     #outgoingD['ipAddr'] = check_connection()
     # mqtt_client.publish(MQTT_PUB_RPI_TOPIC, json.dumps(outgoingD['ipAddr']))  # publish IP address info
-    mqtt_newmsg = False
-    t0_sec = perf_counter()
-    msginterval = 3.0  # Adjust for how often data should be collected. DHT11 min is 2sec
-    
+
+    # Scheduler sleeps until the next deadline (fixed rate, no drift) so the loop idles between samples
+    # With PARALLEL_SAMPLING the scheduled job only starts a read. Results are published by publish_sample
+    scheduler = Scheduler()
+    engine = None
+    if PARALLEL_SAMPLING:
+        from sampling import SamplingEngine   # Imported here: pulls in multiprocessing and concurrent.futures
+        processes = SAMPLING_PROCESSES if any(s.executor == 'process' for s in demoHostMachine.values()) else 0
+        engine = SamplingEngine(publish_sample, threads=SAMPLING_THREADS, processes=processes)
+    for idx, demoSensor in demoHostMachine.items():
+        if engine is not None:
+            engine.add_sensor(idx, demoSensor.reader, executor=demoSensor.executor, timeout=demoSensor.read_timeout)
+            scheduler.every(demoSensor.interval, engine.sample, idx, name="demoSensor{0}".format(idx))
+        else:
+            scheduler.every(demoSensor.interval, sample_and_publish, idx, demoSensor, name="demoSensor{0}".format(idx))
+    scheduler.every(METRICS_INTERVAL, publish_metrics)
+    if batcher is not None:
+        scheduler.every(PUBLISH_BATCH_INTERVAL, batcher.flush)
+
+    # Extra values in each metrics snapshot
+    metrics.add_source('reconnects', lambda: supervisor.reconnects)
+    metrics.add_source('spool', lambda: len(spool))
+    metrics.add_source('inbound', lambda: [inbound.depth, inbound.dropped_oldest + inbound.dropped_newest])
+    metrics.add_source('jitter_ms', lambda: {name: [job['mean_ms'], job['max_ms'], job['missed']]
+                                             for name, job in scheduler.stats().items()})
+    metrics.add_source('startup_sec', lambda: mqtt_client.startup_sec)
+    metrics.add_source('publish', lambda: [pipeline.inflight, pipeline.dropped, pipeline.coalesced])
+    metrics.add_source('log', lambda: [tracer.traced, tracing.queue_handler.dropped])
+    if engine is not None:
+        metrics.add_source('sensors', engine.health)
+
     try:
-        while True:
-            if (perf_counter() - t0_sec) > msginterval:
-                t0_sec = perf_counter()
-                try:
-                    for idx, demoSensor in demoHostMachine.items():
-                        sensorData1 = float(random.randrange(1, 50, 1))
-                        sensorData2 = int(random.randrange(1, 50, 1))
-                        outgoingD['data']['demoSensori'] = idx
-                        outgoingD['data']['sensorData1f'] = sensorData1
-                        outgoingD['data']['sensorData2i'] = sensorData2
-                        mqtt_client.publish(demoSensor.topic, json.dumps(outgoingD['data']))  # publish data
-                        logging.debug("(mqtt) Demo sensor {}".format(outgoingD))
-                except RuntimeError as error:
-                    logging.info(error.args[0])
-                    continue
+        scheduler.run()
     except KeyboardInterrupt:
         logging.info("Pressed ctrl-C")
     finally:
+        logging.info("(sched) jitter stats: {0}".format(scheduler.stats()))
+        logging.info("(inbound) queue stats: {0}".format(inbound.stats()))
+        logging.info("(mqtt) supervisor stats: {0}".format(supervisor.stats()))
+        logging.info("(mqtt) publish pipeline stats: {0}".format(pipeline.stats()))
+        if engine is not None:
+            logging.info("(sample) sampling stats: {0}".format(engine.stats()))
+            engine.close()
+        if batcher is not None:
+            batcher.flush()                # Last partial batch (spooled if it can't be sent)
+        inbound.stop(timeout=1.0)
+        supervisor.stop(timeout=2.0)
+        spool.close()
         logging.info("GPIO cleaned up automatically with gpiozero")
+        log_listener.stop()                # Writes out the queued log records
 
 if __name__ == "__main__":     # Will run main() code when program is executed as a script (vs imported as a module)
     main()
@@ -0,0 +1,101 @@
+# Run with: python3 -m pytest -q test_supervisor.py
+# Concurrent publishers through ReconnectSupervisor against a peer that reads slowly. Socket writes
+# are partial then, and the byte stream must still parse as whole, intact PUBLISH packets.
+# Payloads are larger than one loopback segment (~64 KB) since smaller sends on loopback are written
+# whole or not at all, and the race needs partial writes.
+
+import socket, struct, threading
+from time import sleep
+import paho.mqtt.client as mqtt
+
+from supervisor import ReconnectSupervisor
+
+PUBLISHERS = 6
+PER_PUBLISHER = 30
+PAYLOAD_SIZE = 100000
+
+def _read_packet(sock):
+    """ One MQTT packet as (first byte, body) or None at EOF """
+    header = sock.recv(1)
+    if not header:
+        return None
+    length, shift = 0, 0
+    while True:
+        byte = sock.recv(1)[0]
+        length += (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    body = b''
+    while len(body) < length:
+        chunk = sock.recv(min(length - len(body), 16384))
+        if not chunk:
+            raise EOFError("stream ended inside a packet")
+        body += chunk
+        sleep(0.001)                  # Slow reader: the client's socket buffer fills, writes go partial
+    return header[0], body
+
+def _slow_peer(server, packets, errors):
+    conn, _ = server.accept()
+    try:
+        first, _ = _read_packet(conn)
+        assert first >> 4 == 1, "expected CONNECT"
+        conn.sendall(bytes([0x20, 2, 0, 0]))                      # CONNACK, accepted
+        while len(packets) < PUBLISHERS * PER_PUBLISHER:
+            packet = _read_packet(conn)
+            if packet is None:
+                break
+            first, body = packet
+            if first >> 4 != 3:                                  # Only PUBLISH expected (qos 0)
+                if first >> 4 == 12:                             # PINGREQ
+                    conn.sendall(bytes([0xD0, 0]))
+                    continue
+                raise ValueError("unexpected packet type {0}".format(first >> 4))
+            n = struct.unpack_from('!H', body)[0]
+            topic, payload = body[2:2 + n].decode(), body[2 + n:]
+            packets.append((topic, payload))
+    except Exception as error:
+        errors.append(error)
+    finally:
+        conn.close()
+
+def test_concurrent_publishers_keep_packets_intact():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    packets, errors = [], []
+    peer = threading.Thread(target=_slow_peer, args=(server, packets, errors), daemon=True)
+    peer.start()
+
+    client = mqtt.Client('supervisor-test')
+    # Small send buffer so the socket fills quickly and writes go partial
+    client.on_socket_open = lambda c, u, sock: sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8192)
+    client.connect_async('127.0.0.1', port)
+    supervisor = ReconnectSupervisor(client, loop_timeout=0.1).start()
+    for _ in range(100):
+        if client.is_connected():
+            break
+        sleep(0.05)
+    assert client.is_connected()
+
+    def publisher(n):
+        payload = bytes([n]) * PAYLOAD_SIZE
+        for _ in range(PER_PUBLISHER):
+            supervisor.publish('test/{0}'.format(n), payload)
+            sleep(0.002)              # Spread out like sampler threads so publishes overlap the writes
+    threads = [threading.Thread(target=publisher, args=(n,)) for n in range(PUBLISHERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    peer.join(30.0)
+    supervisor.stop(timeout=2.0)
+    client.disconnect()
+    server.close()
+
+    assert not errors, errors
+    assert len(packets) == PUBLISHERS * PER_PUBLISHER
+    for topic, payload in packets:
+        n = int(topic.split('/')[1])
+        assert payload == bytes([n]) * PAYLOAD_SIZE
@@ -0,0 +1,124 @@
+#====== LOGGING AND SAMPLED TRACING =====#
+# Logging on the hot paths (every message in, every sample out) used to format strings for every
+# message even with debug output off, and wrote to the console on the calling thread.
+#  - setup_logging() sends log records through a bounded queue to a background writer thread
+#    (QueueHandler/QueueListener). The calling thread only enqueues. A full queue drops the record.
+#  - tracer replaces per-message debug logging. Disabled it costs one attribute check at the call
+#    site. Enabled it traces 1 in 'every' messages, at most 'per_sec' per second.
+#  - configure() changes the log level and the tracer at runtime (template.py: {"cmd": "log", ...}).
+#     listener = setup_logging(logging.INFO)
+#     if tracer.enabled and tracer.sample():                 # Guard at the call site. No call when off
+#         tracer.trace("(mqtt) Demo sensor %s", data)         # %-args. Formatted only for sampled messages
+#     configure(level='DEBUG', trace=True, every=10, per_sec=5)
+
+import logging, queue
+from logging.handlers import QueueHandler, QueueListener
+from time import monotonic
+
+SWITCH = {'true': True, 'on': True, '1': True, 'false': False, 'off': False, '0': False}   # trace as a string
+
+class DroppingQueueHandler(QueueHandler):
+    """ Never blocks the logging thread. Records that don't fit in the queue are counted and dropped """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class Tracer:
+    """ 1 in 'every' sampling with a per second cap (per_sec 0 = no cap). The counters are not locked so
+        with several threads tracing the sampling is approximate, which is fine for diagnostics """
+    __slots__ = ('logger', 'enabled', 'every', 'per_sec', '_n', '_second', '_in_second', 'traced', 'suppressed')
+
+    def __init__(self, logger, every=100, per_sec=5):
+        self.logger = logger
+        self.enabled = False
+        self.every = every
+        self.per_sec = per_sec
+        self._n = 0
+        self._second = 0
+        self._in_second = 0
+        self.traced = 0
+        self.suppressed = 0           # Sampled but over the per second cap
+
+    def sample(self):
+        """ True if this message should be traced """
+        self._n += 1
+        if self._n < self.every:
+            return False
+        self._n = 0
+        if self.per_sec:
+            second = int(monotonic())
+            if second != self._second:
+                self._second = second
+                self._in_second = 0
+            if self._in_second >= self.per_sec:
+                self.suppressed += 1
+                return False
+            self._in_second += 1
+        self.traced += 1
+        return True
+
+    def trace(self, msg, *args):
+        self.logger.info(msg, *args)
+
+    def stats(self):
+        return {'enabled': self.enabled, 'every': self.every, 'per_sec': self.per_sec,
+                'traced': self.traced, 'suppressed': self.suppressed}
+
+# Traces use their own logger so they show at any root level (INFO in production)
+_trace_logger = logging.getLogger('trace')
+_trace_logger.setLevel(logging.INFO)
+tracer = Tracer(_trace_logger)
+queue_handler = None
+
+def setup_logging(level=logging.INFO, maxsize=10000, handlers=None):
+    """ Replaces logging.basicConfig(). Root logger -> bounded queue -> listener thread -> handlers
+        (default: stderr with the basicConfig format). Returns the started QueueListener, stop() it at exit """
+    global queue_handler
+    if not handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        handlers = [handler]
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def configure(level=None, trace=None, every=None, per_sec=None):
+    """ Change the root log level ('DEBUG', 'INFO', .. or a number) and the tracer. None = leave as is.
+        trace = True/False or one of the SWITCH strings. Raises ValueError for bad values. Returns the current settings """
+    if isinstance(level, str):
+        number = logging.getLevelName(level.upper())
+        if not isinstance(number, int):
+            raise ValueError("unknown log level {0}".format(level))
+        level = number
+    if isinstance(trace, str) and trace.strip().lower() in SWITCH:
+        trace = SWITCH[trace.strip().lower()]
+    elif trace is not None and not isinstance(trace, bool):
+        raise ValueError("trace must be true or false (got {0!r})".format(trace))
+    if every is not None and int(every) < 1:
+        raise ValueError("every must be >= 1 (got {0})".format(every))
+    if per_sec is not None and int(per_sec) < 0:
+        raise ValueError("per_sec must be >= 0 (got {0})".format(per_sec))
+    if level is not None:                 # All values checked. Apply
+        logging.getLogger().setLevel(level)
+    if every is not None:
+        tracer.every = int(every)
+    if per_sec is not None:
+        tracer.per_sec = int(per_sec)
+    if trace is not None:
+        tracer.enabled = trace
+    return settings()
+
+def settings():
+    return dict(tracer.stats(), level=logging.getLevelName(logging.getLogger().getEffectiveLevel()),
+                dropped=queue_handler.dropped if queue_handler is not None else 0)